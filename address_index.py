@@ -0,0 +1,143 @@
+from collections import defaultdict
+from collections.abc import Iterable
+from typing import NamedTuple
+
+from address_similarity import (
+    PREFECTURE_ONLY_SIMILARITY,
+    ParsedAddress,
+    normalize_address,
+    parse_address,
+    score_parsed_addresses,
+)
+
+
+class AddressMatch(NamedTuple):
+    """
+    AddressIndex.match の結果。
+    candidate: いちばん似ている候補 (閾値に届かなければ None)。
+    score: その類似度 (0.0-1.0)。閾値に届かなくても、いちばん高かったスコアが入る。
+    """
+
+    candidate: dict | None
+    score: float
+
+
+class AddressIndex:
+    """
+    住所で候補を引くためのインデックス。
+    jn.find_best_match_by_location は候補をぜんぶ calculate_address_similarity で比べるので、
+    候補が数万件あると1件引くたびに数万回比べることになる。
+    ここでは候補を先に分解 (parse_address) して、市区町村ごと (と、正規化後の住所ごと) のバケツに入れておき、
+    引くときは同じバケツの候補だけを比べる。
+
+    NOTE: calculate_address_similarity は、
+        - 正規化後の住所が同じ -> 1.0
+        - 市区町村が同じ -> 0.6 以上
+        - 都道府県だけ同じ -> 0.3
+        - それ以外 -> 0.0
+    なので、閾値が 0.3 より大きければ「同じ住所」と「同じ市区町村」のバケツだけ見れば、全件比べたときと同じ結果になる。
+    閾値が 0.3 以下なら、同じ都道府県のバケツも見る。
+    閾値が 0.3 より大きくても、そこで 0.3 に届かなければ、同じ都道府県の候補があるかだけ見てスコアを 0.3 にする。
+    (同じ都道府県で市区町村が違う候補は、みんなちょうど 0.3 なので、ぜんぶ比べなくていい)
+    同点なら、候補を入れた順番で先のもの (find_best_match_by_location と同じ)。
+    """
+
+    def __init__(self, candidates: Iterable[dict] = (), location_key: str = "location", threshold: float = 0.7) -> None:
+        self.location_key = location_key
+        self.threshold = threshold
+        self._candidates: list[dict] = []
+        self._parsed: list[ParsedAddress] = []
+        self._by_normalized: dict[str, list[int]] = defaultdict(list)
+        self._by_city: dict[str, list[int]] = defaultdict(list)
+        self._by_prefecture: dict[str, list[int]] = defaultdict(list)
+        # calculate_address_similarity 相当の比較をした回数。 (全件比べた場合との比較用)
+        self.comparisons = 0
+        for candidate in candidates:
+            self.add(candidate)
+
+    def __len__(self) -> int:
+        return len(self._candidates)
+
+    def add(self, candidate: dict) -> None:
+        """
+        候補を1件追加します。住所が空の候補は、どの住所とも一致しない (calculate_address_similarity と同じ)。
+        """
+        i = len(self._candidates)
+        self._candidates.append(candidate)
+        location = candidate.get(self.location_key) or ""
+        if not location:
+            self._parsed.append(ParsedAddress("", "", ""))
+            return
+
+        normalized = normalize_address(location)
+        parsed = parse_address(normalized)
+        self._parsed.append(parsed)
+        self._by_normalized[normalized].append(i)
+        if parsed.city:
+            self._by_city[parsed.city].append(i)
+        if parsed.prefecture:
+            self._by_prefecture[parsed.prefecture].append(i)
+
+    def match(self, target_location: str) -> AddressMatch:
+        """
+        target_location にいちばん似ている候補を返します。
+        """
+        if not target_location:
+            return AddressMatch(None, 0.0)
+
+        normalized = normalize_address(target_location)
+        parsed = parse_address(normalized)
+
+        # {候補の番号: 類似度}
+        scores: dict[int, float] = {}
+        for i in self._by_normalized.get(normalized, ()):
+            scores[i] = 1.0
+        blocks = [self._by_city.get(parsed.city, ())] if parsed.city else []
+        if self.threshold <= PREFECTURE_ONLY_SIMILARITY and parsed.prefecture:
+            blocks.append(self._by_prefecture.get(parsed.prefecture, ()))
+        for block in blocks:
+            for i in block:
+                if i not in scores:
+                    scores[i] = score_parsed_addresses(parsed, self._parsed[i])
+        self.comparisons += len(scores)
+
+        best_index = None
+        best_score = 0.0
+        for i in sorted(scores):
+            if scores[i] > best_score:
+                best_score = scores[i]
+                best_index = i
+
+        # NOTE: 閾値が 0.3 より大きいと都道府県のバケツは比べていないので、スコアだけ全件比べたときと合わせる。
+        if best_score < PREFECTURE_ONLY_SIMILARITY and parsed.prefecture:
+            same_prefecture = self._by_prefecture.get(parsed.prefecture, ())
+            if same_prefecture:
+                best_score = PREFECTURE_ONLY_SIMILARITY
+                best_index = same_prefecture[0]
+
+        # 閾値を超えた場合のみ返す
+        if best_index is None or best_score < self.threshold:
+            return AddressMatch(None, best_score)
+        return AddressMatch(self._candidates[best_index], best_score)
+
+    def match_all(self, target_locations: Iterable[str]) -> list[AddressMatch]:
+        """
+        住所をまとめて引きます。結果は target_locations と同じ順番。
+        """
+        return [self.match(target_location) for target_location in target_locations]
+
+
+# 動作確認用
+# pipenv run python address_index.py
+if __name__ == "__main__":
+    index = AddressIndex(
+        [
+            {"company_name": "FOO", "location": "岩手県FOO市江刺区田原字横懸248-9"},
+            {"company_name": "BAR", "location": "岩手県FOO市BAR区佐倉河字BAZ71"},
+            {"company_name": "BAZ", "location": "〒541-0053 大阪府大阪市中央区本町４丁目４−１２"},
+        ]
+    )
+    for target in ["岩手県 FOO市 BAR佐倉河字BAZ71番地", "埼玉県春日部市南栄町11-7"]:
+        candidate, score = index.match(target)
+        print(f"{target}: {score:.2f} {candidate}")
+    print(f"比較回数: {index.comparisons}")
@@ -1,67 +1,180 @@
 import re
+from functools import lru_cache
+from typing import NamedTuple
+
+import pandas as pd
+
+from shared import map_unique_values
+
+# 郵便番号。
+_POSTAL_CODE_RE = re.compile(r"〒\d{3}-\d{4}\s*")
+
+# 漢数字 -> 半角数値。
+_KANJI_TO_NUMBER = {
+    "一": "1",
+    "二": "2",
+    "三": "3",
+    "四": "4",
+    "五": "5",
+    "六": "6",
+    "七": "7",
+    "八": "8",
+    "九": "9",
+    "十": "10",
+}
+
+# 漢数字 -> 半角数値、全角数字 -> 半角、スペース除去 を1回の translate でやるためのテーブル。
+# NOTE: どれも1文字 -> 別の文字 (か削除) で、変換後の文字がほかの変換の対象にならないので、まとめても結果は同じ。
+_CHARACTER_TABLE = str.maketrans(
+    {
+        **_KANJI_TO_NUMBER,
+        **{zenkaku: str(i) for i, zenkaku in enumerate("０１２３４５６７８９")},
+        " ": None,
+        "　": None,
+    }
+)
+
+# ハイフンたちの除去。
+_HYPHEN_TABLE = str.maketrans({"−": None, "-": None})
+
+# "市の中にある区"。
+_WARD_IN_CITY_RE = re.compile(r"(市[^市区町村]{1,10})区")
+
+# 都道府県。
+PREFECTURES = (
+    "北海道", "青森県", "岩手県", "宮城県", "秋田県", "山形県", "福島県", "茨城県", "栃木県", "群馬県",
+    "埼玉県", "千葉県", "東京都", "神奈川県", "新潟県", "富山県", "石川県", "福井県", "山梨県", "長野県",
+    "岐阜県", "静岡県", "愛知県", "三重県", "滋賀県", "京都府", "大阪府", "兵庫県", "奈良県", "和歌山県",
+    "鳥取県", "島根県", "岡山県", "広島県", "山口県", "徳島県", "香川県", "愛媛県", "高知県", "福岡県",
+    "佐賀県", "長崎県", "熊本県", "大分県", "宮崎県", "鹿児島県", "沖縄県",
+)  # fmt: skip
 
+# 都道府県だけ一致したときの類似度。
+PREFECTURE_ONLY_SIMILARITY = 0.3
 
+# normalize_address が覚えておく住所の数。
+NORMALIZE_CACHE_SIZE = 8192
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
 def normalize_address(address: str) -> str:
     """
     住所さあ! 書き方いろいろありすぎなんだよ!
     正規化する! (スペース、記号、数字統一)
+    NOTE: 同じ住所を何回も正規化するので、結果を覚えておく。 normalize_address.cache_info() でヒット率が見られる。
     """
     if not address:
         return ""
 
     # 郵便番号を除去。
     # NOTE: csv の住所に郵便番号は無い。
-    address = re.sub(r"〒\d{3}-\d{4}\s*", "", address)
+    address = _POSTAL_CODE_RE.sub("", address)
 
     # 漢数字を半角数値に変換。
     # NOTE: ここで住所が誤ることもあるが、これはマッチングのためだけの変換だから問題ない。
-    address = _convert_kanji_to_number(address)
-
     # 全角数字を半角に変換。
-    address = address.translate(str.maketrans("０１２３４５６７８９", "0123456789"))
-
     # スペースたちを除去。
-    address = address.replace(" ", "").replace("　", "")
+    address = address.translate(_CHARACTER_TABLE)
 
     # 住所表記の統一
+    # NOTE: 順番に意味がある (例: "丁-目" はハイフン除去のあとで "丁目" として消える) ので、この順番を守ること。
     address = address.replace("番地", "")
-    address = address.replace("−", "")
-    address = address.replace("-", "")
+    address = address.translate(_HYPHEN_TABLE)
     address = address.replace("丁目", "")
     address = address.replace("号", "")
 
     # "市の中にある区" を除去。 (例: XX市XX区 → XX市)
     # NOTE: なんかね……区を書かない場合があるようだから。
-    address = re.sub(r"(市[^市区町村]{1,10})区", r"\1", address)
+    address = _WARD_IN_CITY_RE.sub(r"\1", address)
 
     return address
 
 
-def _convert_kanji_to_number(text: str) -> str:
+def normalize_address_series(addresses: pd.Series) -> pd.Series:
     """
-    漢数字を半角数値に変換する
+    normalize_address の Series 版。 NaN は NaN のまま。
+    NOTE: 同じ住所は1回しか正規化しない。 (normalize_address の覚えておける数を超える列でも)
     """
-    if not text:
-        return ""
+    return map_unique_values(addresses, normalize_address.__wrapped__)
+
+
+class ParsedAddress(NamedTuple):
+    """
+    正規化済みの住所を、都道府県 / 市区町村 / 残り に分けたもの。
+    見つからなかった項目は空文字列。
+    NOTE: 政令市の区は normalize_address で消えている (XX市XX区 → XX市XX) ので、区の名前は残りの頭に入る。
+    """
+
+    prefecture: str
+    city: str
+    remainder: str
+    # 市区町村より前にあった部分 (都道府県を除く)。ふつうは空。
+    before_city: str = ""
+
+    def after_city(self) -> str:
+        """
+        都道府県と市区町村を除いた部分を、もとの順番のまま。
+        """
+        return self.before_city + self.remainder
 
-    kanji_map = {
-        "一": "1",
-        "二": "2",
-        "三": "3",
-        "四": "4",
-        "五": "5",
-        "六": "6",
-        "七": "7",
-        "八": "8",
-        "九": "9",
-        "十": "10",
-    }
 
-    # 基本的な一桁漢数字を変換
-    for kanji, digit in kanji_map.items():
-        text = text.replace(kanji, digit)
+# 都道府県。
+_PREFECTURE_RE = re.compile("|".join(PREFECTURES))
 
-    return text
+# 市区町村: 都道府県の字を含まない、いちばん短い "〜市区町村"。
+_CITY_RE = re.compile(r"[^都道府県]+?[市区町村]")
+
+# 市区町村名の辞書 (任意) の正規表現。 load_gazetteer で作る。
+_municipality_re: re.Pattern[str] | None = None
+
+
+def load_gazetteer(path: str) -> int:
+    """
+    市区町村名の辞書ファイル (1行に1個。 CSV なら1列目) を読み込みます。読み込んだ数を返す。
+    読み込んでおくと、 parse_address は「〇〇市」みたいな規則ではなく、辞書にある名前で市区町村を切り出す。
+    NOTE: 辞書の名前も normalize_address で正規化してから登録する (照合する住所と同じ形にするため)。
+    """
+    global _municipality_re
+    names = set()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            name = normalize_address(line.split(",", 1)[0].strip())
+            if name:
+                names.add(name)
+    # NOTE: 同じ位置から始まる名前がいくつかあるときは長いほうを取りたいので、長い順に並べる。
+    _municipality_re = re.compile("|".join(map(re.escape, sorted(names, key=len, reverse=True)))) if names else None
+    parse_address.cache_clear()
+    return len(names)
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def parse_address(normalized_address: str) -> ParsedAddress:
+    """
+    normalize_address 済みの住所を、都道府県 / 市区町村 / 残り に分けます。
+    - 都道府県: いちばん左にある都道府県名。
+    - 市区町村: 辞書があれば辞書の名前、無ければ「都道府県の字を含まない、いちばん短い "〜市区町村"」。
+    - 残り: それ以外ぜんぶ。 市区町村より前にあった部分は before_city 。
+    NOTE: 切り出しはどれもコンパイル済みの正規表現 (C で動く) でやる。 Python で1文字ずつなめるより速い。
+    """
+    text = normalized_address
+
+    # 都道府県
+    prefecture_match = _PREFECTURE_RE.search(text)
+    if prefecture_match:
+        prefecture = prefecture_match.group()
+        rest = text[: prefecture_match.start()] + text[prefecture_match.end() :]
+    else:
+        prefecture, rest = "", text
+
+    # 市区町村
+    city_match = _municipality_re.search(rest) if _municipality_re is not None else None
+    if city_match is None:
+        city_match = _CITY_RE.search(rest)
+    if city_match is None:
+        return ParsedAddress(prefecture, "", rest)
+    city_start, city_end = city_match.span()
+
+    return ParsedAddress(prefecture, city_match.group(), rest[city_end:], rest[:city_start])
 
 
 def calculate_address_similarity(addr1: str, addr2: str) -> float:
@@ -79,31 +192,25 @@ def calculate_address_similarity(addr1: str, addr2: str) -> float:
     if norm_addr1 == norm_addr2:
         return 1.0
 
-    # 都道府県の抽出と比較
-    prefecture_pattern = r"(北海道|青森県|岩手県|宮城県|秋田県|山形県|福島県|茨城県|栃木県|群馬県|埼玉県|千葉県|東京都|神奈川県|新潟県|富山県|石川県|福井県|山梨県|長野県|岐阜県|静岡県|愛知県|三重県|滋賀県|京都府|大阪府|兵庫県|奈良県|和歌山県|鳥取県|島根県|岡山県|広島県|山口県|徳島県|香川県|愛媛県|高知県|福岡県|佐賀県|長崎県|熊本県|大分県|宮崎県|鹿児島県|沖縄県)"
+    # 都道府県 / 市区町村 / 残り に分ける
+    parsed1 = parse_address(norm_addr1)
+    parsed2 = parse_address(norm_addr2)
+    return score_parsed_addresses(parsed1, parsed2)
 
-    pref1 = re.search(prefecture_pattern, norm_addr1)
-    pref2 = re.search(prefecture_pattern, norm_addr2)
 
+def score_parsed_addresses(parsed1: ParsedAddress, parsed2: ParsedAddress) -> float:
+    """
+    分けた住所どうしの類似度 (0.0-1.0)。完全一致のチェックは済んでいる前提。
+    """
     # 都道府県が不一致 -> 0.0
-    if pref1 and pref2 and pref1.group(1) != pref2.group(1):
+    if parsed1.prefecture and parsed2.prefecture and parsed1.prefecture != parsed2.prefecture:
         return 0.0
 
-    # 市区町村の抽出と比較
-    city_pattern = r"([^都道府県]+?[市区町村])"
-
-    # 都道府県を除去してから市区町村を抽出
-    addr1_without_pref = norm_addr1.replace(pref1.group(1), "") if pref1 else norm_addr1
-    addr2_without_pref = norm_addr2.replace(pref2.group(1), "") if pref2 else norm_addr2
-
-    city1 = re.search(city_pattern, addr1_without_pref)
-    city2 = re.search(city_pattern, addr2_without_pref)
-
     # 市区町村が一致する場合
-    if city1 and city2 and city1.group(1) == city2.group(1):
+    if parsed1.city and parsed1.city == parsed2.city:
         # 残りの部分の類似度を計算
-        remaining1 = addr1_without_pref.replace(city1.group(1), "")
-        remaining2 = addr2_without_pref.replace(city2.group(1), "")
+        remaining1 = parsed1.after_city()
+        remaining2 = parsed2.after_city()
 
         # 残りの部分の共通部分を計算
         common_chars = 0
@@ -123,8 +230,8 @@ def calculate_address_similarity(addr1: str, addr2: str) -> float:
         return min(similarity, 1.0)
 
     # 都道府県のみ一致
-    if pref1 and pref2 and pref1.group(1) == pref2.group(1):
-        return 0.3
+    if parsed1.prefecture and parsed1.prefecture == parsed2.prefecture:
+        return PREFECTURE_ONLY_SIMILARITY
 
     return 0.0
 
@@ -0,0 +1,88 @@
+"""
+住所の分解 (都道府県 / 市区町村 / 残り) の速さを、 parse_address ともとの正規表現のやり方で比べる。
+ついでに、両方のやり方で都道府県と市区町村 (と、それ以外の部分) が同じになるかも数える。
+
+pipenv run python bench_parse_address.py --samples 50000
+pipenv run python bench_parse_address.py --samples 50000 --gazetteer ./municipalities.csv
+"""
+
+import argparse
+import logging
+import random
+import re
+import time
+
+from address_similarity import PREFECTURES, load_gazetteer, normalize_address, parse_address
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# もとのやり方 (calculate_address_similarity で使っていた正規表現)。
+PREFECTURE_PATTERN = "(" + "|".join(PREFECTURES) + ")"
+CITY_PATTERN = r"([^都道府県]+?[市区町村])"
+
+CITY_NAMES = ["FOO市", "BAR郡BAZ町", "QUX村", "横浜市", "中央区", "春日部市", "大阪市", "那覇市"]
+WARD_NAMES = ["", "", "中区", "江刺区", "北区"]
+REMAINDERS = ["本町4-4-12", "佐倉河字BAZ71", "大字BAR133-70", "泉9丁目99番1号9999ビル内", "南栄町11-7"]
+
+
+def split_address_with_regex(normalized_address: str) -> tuple[str, str, str]:
+    """
+    もとのやり方で (都道府県, 市区町村, 残り) に分ける。
+    """
+    pref = re.search(PREFECTURE_PATTERN, normalized_address)
+    without_pref = normalized_address.replace(pref.group(1), "") if pref else normalized_address
+    city = re.search(CITY_PATTERN, without_pref)
+    remaining = without_pref.replace(city.group(1), "") if city else without_pref
+    return (pref.group(1) if pref else "", city.group(1) if city else "", remaining)
+
+
+def random_address(rng: random.Random) -> str:
+    return (
+        rng.choice(PREFECTURES)
+        + rng.choice(CITY_NAMES)
+        + rng.choice(WARD_NAMES)
+        + rng.choice(REMAINDERS)
+        + str(rng.randint(1, 9999))
+    )
+
+
+def main() -> None:
+    logger.info("start bench_parse_address")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=50000, help="試す住所の数")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    parser.add_argument("--gazetteer", default=None, help="市区町村名の辞書ファイル (任意)")
+    args = parser.parse_args()
+
+    if args.gazetteer:
+        logger.info(f"辞書読み込みおｋ: {load_gazetteer(args.gazetteer)} 件")
+
+    rng = random.Random(args.seed)
+    # NOTE: どちらのやり方も正規化済みの住所を受け取るので、正規化はここで先に済ませて計測から外す。
+    samples = [normalize_address(random_address(rng)) for _ in range(args.samples)]
+
+    started = time.perf_counter()
+    regex_results = [split_address_with_regex(address) for address in samples]
+    regex_sec = time.perf_counter() - started
+
+    # NOTE: parse_address は結果を覚えるので、覚えていない状態で測る。
+    parse_address.cache_clear()
+    started = time.perf_counter()
+    parsed_results = [parse_address.__wrapped__(address) for address in samples]
+    parsed_sec = time.perf_counter() - started
+
+    same = sum(
+        1
+        for regex_result, parsed in zip(regex_results, parsed_results)
+        if regex_result == (parsed.prefecture, parsed.city, parsed.after_city())
+    )
+    logger.info(f"{len(samples)} 件中 {same} 件で都道府県、市区町村、残りが一致")
+    logger.info(f"もとの正規表現: {regex_sec:.3f}秒, parse_address: {parsed_sec:.3f}秒")
+
+    logger.info("end bench_parse_address")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+--resource-policy site (画像・フォント・解析系などを読まない Chrome) で、
+ページの準備おｋまでの時間と通信量がどれだけ減るかを測る。
+off と site で、同じ URL を交互に --repeat 回ずつ開いて比べる。 (Chrome のキャッシュは切って測る)
+
+pipenv run python bench_resource_policy.py --site jb --url "https://WWW.JAV.OR.JP/compatible_organizations?page=1&pageSize=100"
+pipenv run python bench_resource_policy.py --site jn --url "https://WWW.JN.COM/searchnumber.do?number=FOO" --repeat 5
+"""
+
+import argparse
+import json
+import logging
+import statistics
+import time
+
+import jb
+import jn
+import shared
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# --site -> (プリセット, 準備おｋ判定)
+SITES = {
+    "jb": (jb.RESOURCE_POLICY, jb.LIST_READY_CONDITION),
+    "jn": (jn.RESOURCE_POLICY, jn.SEARCH_READY_CONDITION),
+}
+
+
+def summarize_network(entries: list[dict]) -> tuple[int, int, int]:
+    """
+    performance ログから (受信バイト数, リクエスト数, ブロックしたリクエスト数) を数える。
+    """
+    received = requests = blocked = 0
+    for entry in entries:
+        message = json.loads(entry["message"])["message"]
+        method = message.get("method")
+        if method == "Network.requestWillBeSent":
+            requests += 1
+        elif method == "Network.loadingFinished":
+            received += int(message["params"].get("encodedDataLength", 0))
+        elif method == "Network.loadingFailed" and message["params"].get("blockedReason"):
+            blocked += 1
+    return received, requests, blocked
+
+
+def measure(pool: shared.ChromeDriverPool, url: str, ready: shared.ReadyCondition, wait_sec: int) -> dict:
+    with pool.driver() as driver:
+        # NOTE: 2回目以降がキャッシュで速く見えないように。
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setCacheDisabled", {"cacheDisabled": True})
+        driver.get_log("performance")
+        started = time.perf_counter()
+        # NOTE: fetch_html_slowly と同じ開き方 (driver.get -> ready まで待つ) で測りたいので、中身を直接使う。
+        html, is_ready = shared._load_page(driver, url, wait_sec, ready=ready)
+        elapsed = time.perf_counter() - started
+        received, requests, blocked = summarize_network(driver.get_log("performance"))
+    return {
+        "sec": elapsed,
+        "bytes": received,
+        "requests": requests,
+        "blocked": blocked,
+        "html": len(html),
+        "ready": is_ready,
+    }
+
+
+def main() -> None:
+    logger.info("start bench_resource_policy")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--site", choices=sorted(SITES), required=True, help="どのサイトのプリセットで測るか")
+    parser.add_argument("--url", action="append", required=True, help="開く URL (何個でも)")
+    parser.add_argument("--repeat", type=int, default=3, help="URL ごとに何回ずつ開くか")
+    parser.add_argument("--wait-sec", type=int, default=30, help="準備おｋを待つ最大秒数")
+    args = parser.parse_args()
+
+    site_policy, ready = SITES[args.site]
+    policies = {"off": None, "site": site_policy}
+    results: dict[str, list[dict]] = {name: [] for name in policies}
+
+    pools = {
+        name: shared.ChromeDriverPool(size=1, capture_network=True, resource_policy=policy)
+        for name, policy in policies.items()
+    }
+    try:
+        for url in args.url:
+            for i in range(args.repeat):
+                # NOTE: 時間帯によるサイトの重さの違いが片方に偏らないよう、 off と site を交互に開く。
+                for name, pool in pools.items():
+                    result = measure(pool, url, ready, args.wait_sec)
+                    results[name].append(result)
+                    logger.info(
+                        f"{name} {i + 1}/{args.repeat}: {result['sec']:.2f}秒, {result['bytes'] / 1024:.0f}KB, "
+                        f"リクエスト {result['requests']} (ブロック {result['blocked']}), HTML {result['html']} 文字"
+                        f"{'' if result['ready'] else ' (ready にならなかった)'}"
+                    )
+    finally:
+        for pool in pools.values():
+            pool.close()
+
+    for name, rows in results.items():
+        logger.info(
+            f"{name}: 準備おｋまで 中央値 {statistics.median(r['sec'] for r in rows):.2f}秒, "
+            f"受信 平均 {statistics.mean(r['bytes'] for r in rows) / 1024:.0f}KB, "
+            f"リクエスト 平均 {statistics.mean(r['requests'] for r in rows):.1f}"
+        )
+
+    logger.info("end bench_resource_policy")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+速くした normalize_address が、もとの実装とまったく同じ文字列を返すかを、ランダムな住所っぽい文字列で確かめる。
+
+pipenv run python check_normalize_address.py --samples 200000
+"""
+
+import argparse
+import logging
+import random
+import re
+import sys
+import time
+
+from address_similarity import normalize_address
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# 正規化で扱う文字を多めに混ぜた文字セット。 (ふつうの住所の文字も少し)
+ALPHABET = (
+    "〒0123456789０１２３４５６７８９一二三四五六七八九十 　\t\n番地−-丁目号市区町村都道府県"
+    "東京大阪北海京都神奈川中央本町字大横懸ビル内FOOBAR"
+)
+
+# 実際の住所に近いかけら。
+FRAGMENTS = [
+    "〒541-0053 ",
+    "〒０３９-３２１３ ",
+    "東京都",
+    "大阪府",
+    "XX市",
+    "YY区",
+    "ZZ町",
+    "三丁目",
+    "8番16号",
+    "１３３−７０",
+]
+
+
+def normalize_address_original(address: str) -> str:
+    """
+    速くする前の normalize_address (比較用にそのまま残している)。
+    """
+    if not address:
+        return ""
+    address = re.sub(r"〒\d{3}-\d{4}\s*", "", address)
+    kanji_map = {
+        "一": "1",
+        "二": "2",
+        "三": "3",
+        "四": "4",
+        "五": "5",
+        "六": "6",
+        "七": "7",
+        "八": "8",
+        "九": "9",
+        "十": "10",
+    }
+    for kanji, digit in kanji_map.items():
+        address = address.replace(kanji, digit)
+    address = address.translate(str.maketrans("０１２３４５６７８９", "0123456789"))
+    address = address.replace(" ", "").replace("　", "")
+    address = address.replace("番地", "")
+    address = address.replace("−", "")
+    address = address.replace("-", "")
+    address = address.replace("丁目", "")
+    address = address.replace("号", "")
+    address = re.sub(r"(市[^市区町村]{1,10})区", r"\1", address)
+    return address
+
+
+def random_address(rng: random.Random) -> str:
+    parts = []
+    for _ in range(rng.randint(0, 8)):
+        if rng.random() < 0.3:
+            parts.append(rng.choice(FRAGMENTS))
+        else:
+            parts.append("".join(rng.choice(ALPHABET) for _ in range(rng.randint(1, 6))))
+    return "".join(parts)
+
+
+def main() -> None:
+    logger.info("start check_normalize_address")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=200000, help="試すランダム文字列の数")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    samples = [random_address(rng) for _ in range(args.samples)]
+
+    mismatches = 0
+    for address in samples:
+        expected = normalize_address_original(address)
+        actual = normalize_address(address)
+        if actual != expected:
+            mismatches += 1
+            if mismatches <= 10:
+                logger.error(f"不一致: {address!r} -> もとの実装 {expected!r}, いまの実装 {actual!r}")
+    logger.info(f"{len(samples)} 件中 {mismatches} 件で不一致")
+
+    # 速さの比較。 (同じ住所を何回も正規化する、マッチングのときの使われ方に寄せて、同じ入力を5周する)
+    normalize_address.cache_clear()
+    started = time.perf_counter()
+    for _ in range(5):
+        for address in samples[:10000]:
+            normalize_address_original(address)
+    original_sec = time.perf_counter() - started
+    started = time.perf_counter()
+    for _ in range(5):
+        for address in samples[:10000]:
+            normalize_address(address)
+    current_sec = time.perf_counter() - started
+    logger.info(f"もとの実装: {original_sec:.3f}秒, いまの実装: {current_sec:.3f}秒 ({normalize_address.cache_info()})")
+
+    logger.info("end check_normalize_address")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+保存しておいた HTML で、速いパーサ (lxml + 部分木だけパース) の結果が、
+もとのやり方 (html.parser で全体をパース) の結果とまったく同じかを確かめる。
+
+--html-dir を省くと check_fixtures/<kind> (リポジトリに入れてある小さいページ) で確かめる。
+
+pipenv run python check_parser_parity.py --kind jn
+pipenv run python check_parser_parity.py --kind jn --html-dir ./saved_pages/jn --html-parser lxml
+pipenv run python check_parser_parity.py --kind jb --html-dir ./saved_pages/jb --html-parser lxml
+"""
+
+import argparse
+import logging
+import sys
+import time
+from pathlib import Path
+
+import jb
+import jn
+from shared import HTML_PARSER_BACKENDS
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# --html-dir を省いたときに使う、リポジトリに入れてある小さいページ。
+FIXTURES_DIR = Path(__file__).parent / "check_fixtures"
+
+PARSE_FUNCTIONS = {
+    "jn": jn.parse_search_results,
+    "jb": jb.extract_organizations_from_html,
+}
+
+
+def main() -> None:
+    logger.info("start check_parser_parity")
+
+    parser = argparse.ArgumentParser(description="パーサを替えても結果が変わらないかを確かめる")
+    parser.add_argument("--kind", required=True, choices=PARSE_FUNCTIONS.keys(), help="どのパース関数を試すか")
+    parser.add_argument(
+        "--html-dir", default=None, help="保存しておいた HTML (*.html) のディレクトリ (省くと check_fixtures/<kind>)"
+    )
+    parser.add_argument("--html-parser", choices=HTML_PARSER_BACKENDS, default="lxml", help="試すパーサ")
+    args = parser.parse_args()
+
+    parse = PARSE_FUNCTIONS[args.kind]
+    html_dir = Path(args.html_dir) if args.html_dir else FIXTURES_DIR / args.kind
+    html_paths = sorted(html_dir.glob("*.html"))
+    if not html_paths:
+        logger.error(f"HTML が1個も無い: {html_dir}")
+        sys.exit(1)
+
+    mismatches = 0
+    reference_sec = 0.0
+    candidate_sec = 0.0
+    for path in html_paths:
+        html = path.read_text(encoding="utf-8")
+
+        started = time.perf_counter()
+        expected = parse(html, parser="html.parser", restrict=False)
+        reference_sec += time.perf_counter() - started
+
+        started = time.perf_counter()
+        actual = parse(html, parser=args.html_parser, restrict=True)
+        candidate_sec += time.perf_counter() - started
+
+        if actual != expected:
+            mismatches += 1
+            logger.error(f"結果が違う: {path} (もとのやり方 {len(expected)} 件, {args.html_parser} {len(actual)} 件)")
+            for want, got in zip(expected, actual):
+                if want != got:
+                    logger.error(f"  もとのやり方: {want}")
+                    logger.error(f"  {args.html_parser}: {got}")
+                    break
+
+    logger.info(f"{len(html_paths)} ファイル中 {mismatches} ファイルで不一致")
+    logger.info(f"html.parser (全体): {reference_sec:.3f}秒, {args.html_parser} (部分木): {candidate_sec:.3f}秒")
+
+    logger.info("end check_parser_parity")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
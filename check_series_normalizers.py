@@ -0,0 +1,92 @@
+"""
+列まるごとの正規化 (*_series) が、1個ずつの正規化を apply したときとまったく同じ結果になるかを確かめる。
+ついでに、 apply と *_series の速さを比べる。
+
+pipenv run python check_series_normalizers.py --rows 100000 --distinct 20000
+"""
+
+import argparse
+import logging
+import random
+import sys
+import time
+
+import pandas as pd
+
+import jn
+from address_similarity import normalize_address, normalize_address_series
+from name_similarity import normalize_name_for_matching, normalize_name_for_matching_series
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# 正規化で扱う文字を多めに混ぜた文字セット。
+ALPHABET = (
+    "〒0123456789０１２３４５６７８９一二三四五六七八九十 　\t番地−-丁目号市区町村都道府県"
+    "株式有限合同会社ＡＢＣａｂｃABC‐ーｰ・,、。!！?？（）()［］【】「」東京大阪FOO"
+)
+
+# (名前, scalar 版, Series 版)
+NORMALIZERS = [
+    ("jn.remove_spaces", jn.remove_spaces, jn.remove_spaces_series),
+    ("jn.remove_corporate_type", jn.remove_corporate_type, jn.remove_corporate_type_series),
+    (
+        "jn.normalize_symbols_and_zenkaku",
+        jn.normalize_symbols_and_zenkaku,
+        jn.normalize_symbols_and_zenkaku_series,
+    ),
+    ("normalize_name_for_matching", normalize_name_for_matching, normalize_name_for_matching_series),
+    ("normalize_address", normalize_address, normalize_address_series),
+    (
+        "jn.create_search_url",
+        lambda term: jn.create_search_url("https://example.com", term),
+        lambda terms: jn.create_search_urls("https://example.com", terms),
+    ),
+]
+
+
+def main() -> None:
+    logger.info("start check_series_normalizers")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000, help="列の行数")
+    parser.add_argument("--distinct", type=int, default=20000, help="列の中の異なる値の数")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    values = ["".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 30))) for _ in range(args.distinct)]
+    column = pd.Series([rng.choice(values) for _ in range(args.rows)])
+
+    failed = False
+    for name, scalar, series in NORMALIZERS:
+        # NOTE: 覚えている結果があると apply が速く見えるので、毎回消してから測る。
+        normalize_address.cache_clear()
+        normalize_name_for_matching.cache_clear()
+        started = time.perf_counter()
+        expected = column.apply(scalar)
+        apply_sec = time.perf_counter() - started
+
+        normalize_address.cache_clear()
+        normalize_name_for_matching.cache_clear()
+        started = time.perf_counter()
+        actual = series(column)
+        series_sec = time.perf_counter() - started
+
+        mismatches = int((expected != actual).sum())
+        failed = failed or mismatches > 0
+        logger.info(f"{name}: 不一致 {mismatches} 件, apply {apply_sec:.3f}秒, Series 版 {series_sec:.3f}秒")
+
+    # NaN は NaN のまま。
+    with_nan = pd.Series(["株式会社 FOO", None])
+    if not jn.remove_spaces_series(with_nan).isna().tolist() == [False, True]:
+        logger.error("NaN が NaN のままになっていない")
+        failed = True
+
+    logger.info("end check_series_normalizers")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
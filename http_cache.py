@@ -0,0 +1,127 @@
+import gzip
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class CacheMissError(Exception):
+    """
+    オフラインモードで、キャッシュに無い URL を取りに行こうとしたときのエラー。
+    """
+
+
+class ResponseCache:
+    """
+    URL をキーにした、ディスク上の HTTP レスポンスキャッシュ。
+
+    - 本体は URL の sha256 をファイル名にして gzip で保存する。
+    - どのファイルがいつ作られて、いつ読まれたかは SQLite の索引で管理する。
+    - ttl_sec より古いものは無かったことにする。
+    - 合計が max_bytes を超えたら、最後に読まれたのが古いものから消す (LRU)。
+    - reject_markers を含む HTML (401 ページとか) は、成功扱いで保存しない。
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        ttl_sec: float,
+        max_bytes: int,
+        offline: bool = False,
+        reject_markers: tuple[str, ...] = (),
+    ) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.ttl_sec = ttl_sec
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.reject_markers = reject_markers
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # NOTE: 並列に fetch するスレッドから触られるので、接続は1本にしてロックで守る。
+        self._conn = sqlite3.connect(self.cache_dir / "index.sqlite3", check_same_thread=False, isolation_level=None)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY, url TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+
+    def get(self, url: str) -> str | None:
+        """
+        キャッシュにあれば HTML を返します。無い、または期限切れなら None 。
+        """
+        key = self._key(url)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT created_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[0] > self.ttl_sec:
+                self._delete(key)
+                return None
+            try:
+                html = gzip.decompress(self._path(key).read_bytes()).decode("utf-8")
+            except (OSError, EOFError) as e:
+                logger.warning(f"キャッシュが読めなかったので捨てる: {url} ({e})")
+                self._delete(key)
+                return None
+            self._conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        return html
+
+    def put(self, url: str, html: str) -> bool:
+        """
+        HTML を保存します。保存しなかった (reject_markers に引っかかった) ら False 。
+        """
+        if any(marker in html for marker in self.reject_markers):
+            logger.info(f"キャッシュしない (エラーページっぽい): {url}")
+            return False
+
+        key = self._key(url)
+        data = gzip.compress(html.encode("utf-8"))
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        # NOTE: 途中で落ちても壊れたファイルが残らないように、一時ファイルに書いてから置き換える。
+        # NOTE: 複数プロセス (--workers) から同時に書いてもぶつからないように、プロセスとスレッドで名前を分ける。
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        now = time.time()
+        with self._lock:
+            os.replace(tmp_path, path)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, url, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, url, len(data), now, now),
+            )
+            self._evict()
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _evict(self) -> None:
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in self._conn.execute("SELECT key, size FROM entries ORDER BY accessed_at").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._delete(key)
+            total -= size
+            evicted += 1
+        logger.info(f"キャッシュが上限を超えたので {evicted} 件捨てた")
+
+    def _delete(self, key: str) -> None:
+        self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._path(key).unlink(missing_ok=True)
+
+    def _key(self, url: str) -> str:
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.html.gz"
@@ -1,22 +1,66 @@
 import json
 import logging
+import threading
+from collections.abc import Iterator
+from typing import Any
 
-from bs4 import BeautifulSoup
+import requests
+from bs4 import SoupStrainer
 
-from shared import normalize_csv_data
+from shared import (
+    FONT_URL_PATTERNS,
+    STYLESHEET_URL_PATTERNS,
+    TRACKER_URL_PATTERNS,
+    ReadyCondition,
+    ResourcePolicy,
+    fetch_html,
+    fetch_html_with_retry,
+    make_soup,
+    normalize_csv_data,
+)
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
+# 一覧ページの準備おｋ判定。
+# ant-table の行が出たら準備おｋ。
+# NOTE: 空の一覧ページの目印は (保存したページが無くて) わからないので入れていない。 antd の空表示 (ant-empty) は
+#       XHR が返ってくる前の空のテーブルでも出るので、目印にすると描画前のページを「0件」として返してしまう。
+#       空のページは wait_sec でタイムアウトするまで待つ。 (タイムアウトしたページはキャッシュしない)
+LIST_READY_CONDITION = ReadyCondition(selector="tr.ant-table-row")
 
-def extract_organizations_from_html(html: str) -> list[dict[str, str]]:
+# 一覧ページを開く Chrome の --resource-policy site 。
+# テーブルは JS で描画されるので、 CSS が無くても tr.ant-table-row は出る。画像・フォント・CSS・解析系は読まない。
+RESOURCE_POLICY = ResourcePolicy(
+    block_images=True,
+    blocked_url_patterns=FONT_URL_PATTERNS + STYLESHEET_URL_PATTERNS + TRACKER_URL_PATTERNS,
+    page_load_strategy="eager",
+)
+
+
+# 一覧テーブルの行の部分木だけをパースする。
+_ORGANIZATION_ROW_CLASS = "ant-table-row ant-table-row-level-0"
+_ORGANIZATION_ROW_STRAINER = SoupStrainer("tr", class_=_ORGANIZATION_ROW_CLASS)
+_NEXT_DATA_STRAINER = SoupStrainer("script", id="__NEXT_DATA__")
+
+
+def create_list_url(base_url: str, page: int, page_size: int) -> str:
+    """一覧ページの URL を作成する"""
+    return f"{base_url}/compatible_organizations?page={page}&standards=140012015&pageSize={page_size}&nationality=JPN&classification=28"  # noqa: E501
+
+
+def extract_organizations_from_html(
+    html: str, parser: str | None = None, restrict: bool = True
+) -> list[dict[str, str]]:
     """
     指定された HTML から、組織名と詳細ページパスを抽出します。
     [{name, path}, ...]
+    parser: BeautifulSoup のパーサ。 None なら shared.set_html_parser で設定したもの。
+    restrict: True なら一覧テーブルの行の部分木だけをパースする (False は全体をパースする、もとのやり方)。
     """
-    soup = BeautifulSoup(html, "html.parser")
+    soup = make_soup(html, parse_only=_ORGANIZATION_ROW_STRAINER if restrict else None, parser=parser)
     result = []
-    rows = soup.find_all("tr", class_="ant-table-row ant-table-row-level-0")
+    rows = soup.find_all("tr", class_=_ORGANIZATION_ROW_CLASS)
 
     for row in rows:
         link = row.find("a", class_="app-link")
@@ -26,11 +70,124 @@ def extract_organizations_from_html(html: str) -> list[dict[str, str]]:
     return result
 
 
+# 一覧 API の JSON から詳細ページのパスを作るときのテンプレート。 {id} に組織の id が入る。
+# NOTE: 一覧の a.app-link の href と同じ形にしておくこと。
+DETAIL_PATH_TEMPLATE = "/compatible_organizations/{id}"
+
+# 一覧ページがキャプチャした JSON のうち、一覧 API のレスポンスだけを拾うための、 URL に入っている文字列。
+# (shared.fetch_network_json_slowly の url_filter に渡す。国や規格のマスタなど、ほかの API は拾わない)
+LIST_API_URL_FILTER = "/compatible_organizations"
+
+
+def extract_organizations_from_payloads(
+    payloads: list[dict[str, Any]], detail_path_template: str = DETAIL_PATH_TEMPLATE
+) -> list[dict[str, str]]:
+    """
+    一覧ページがキャプチャした JSON (shared.fetch_network_json_slowly の戻り値) から、
+    組織名、詳細ページパス、 (載っていれば) 住所を抽出します。
+    [{name, path, location?}, ...]
+    NOTE: JSON:API の形 ({data: [{id, type, attributes: {name, location, ...}}, ...], included: [...]}) の、
+          いちばん上の data の要素だけを組織として拾う。 included (規格、分類、国など) は組織じゃないので見ない。
+          location が無い組織は、これまでどおり詳細ページで取る。
+    """
+    result = []
+    seen_ids: set[str] = set()
+    for payload in payloads:
+        for resource in _iter_primary_resources(payload["json"]):
+            resource_id = str(resource["id"])
+            if resource_id in seen_ids:
+                continue
+            seen_ids.add(resource_id)
+            organization = {
+                "name": str(resource["attributes"]["name"]).strip(),
+                "path": detail_path_template.format(id=resource_id),
+            }
+            location = resource["attributes"].get("location")
+            if isinstance(location, str):
+                organization["location"] = location
+            result.append(organization)
+    return result
+
+
+def _iter_primary_resources(document: Any) -> Iterator[dict[str, Any]]:
+    """
+    JSON:API のドキュメントの、いちばん上の data にある {id, attributes: {name, ...}} の要素を順番に返す。
+    data が無い JSON (一覧 API じゃないもの) からは何も返さない。
+    """
+    data = document.get("data") if isinstance(document, dict) else None
+    if not isinstance(data, list):
+        return
+    for resource in data:
+        if not isinstance(resource, dict):
+            continue
+        attributes = resource.get("attributes")
+        if "id" in resource and isinstance(attributes, dict) and attributes.get("name"):
+            yield resource
+
+
+# 詳細ページの __NEXT_DATA__ の中で、住所が入っている場所。
+NEXT_DATA_LOCATION_PATH = ("props", "pageProps", "organization", "attributes", "location")
+# /_next/data/<buildId>/... の JSON の中で、住所が入っている場所。 (__NEXT_DATA__ の props の中身だけが返ってくる)
+NEXT_DATA_ROUTE_LOCATION_PATH = NEXT_DATA_LOCATION_PATH[1:]
+
+
 def extract_next_data_from_html(html: str) -> dict:
     """
     指定された HTML から、<script id="__NEXT_DATA__"> に埋め込まれた JSON を抽出する。
+    まず文字列スキャンでその script ブロックだけを切り出して読む (速い)。
+    それがダメなときだけ、 BeautifulSoup で HTML 全体をパースして探す (遅い)。
+    """
+    raw_json = _find_next_data_json(html)
+    if raw_json is not None:
+        try:
+            return json.loads(raw_json)
+        except json.JSONDecodeError:
+            logger.warning("__NEXT_DATA__ の切り出しに失敗したっぽいので、 BeautifulSoup で取り直す")
+    return _extract_next_data_with_soup(html)
+
+
+def extract_next_data_value(html: str, path: tuple[str, ...]) -> Any:
+    """
+    __NEXT_DATA__ の JSON から、 path でたどった先の値だけを返す。
+    例: extract_next_data_value(html, NEXT_DATA_LOCATION_PATH) -> 住所
+    path の途中が無ければ KeyError 。
+    NOTE: 標準の json には部分デコードが無いので、 script ブロックの JSON はまるごとデコードしている。
+          HTML 全体をパースしないぶんで速くしている。
+    """
+    return _get_path(extract_next_data_from_html(html), path)
+
+
+def _get_path(value: Any, path: tuple[str, ...]) -> Any:
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            raise KeyError(f"{'.'.join(path)} が無い ({key} で止まった)")
+        value = value[key]
+    return value
+
+
+def _find_next_data_json(html: str) -> str | None:
+    """
+    <script id="__NEXT_DATA__" ...> と </script> の間の文字列を返す。見つからなければ None 。
+    NOTE: Next.js は JSON 内の "<" を \\u003c にエスケープするので、最初の </script> が閉じタグで OK 。
+    """
+    id_pos = html.find('id="__NEXT_DATA__"')
+    if id_pos == -1:
+        return None
+    tag_start = html.rfind("<script", 0, id_pos)
+    tag_end = html.find(">", id_pos)
+    if tag_start == -1 or tag_end == -1:
+        return None
+    body_end = html.find("</script>", tag_end)
+    if body_end == -1:
+        return None
+    return html[tag_end + 1 : body_end]
+
+
+def _extract_next_data_with_soup(html: str) -> dict:
     """
-    soup = BeautifulSoup(html, "html.parser")
+    BeautifulSoup で HTML 全体をパースして __NEXT_DATA__ を探す (遅いけど確実なほう)。
+    """
+    soup = make_soup(html, parse_only=_NEXT_DATA_STRAINER)
     script_tag = soup.find("script", id="__NEXT_DATA__")
     if script_tag:
         try:
@@ -41,6 +198,58 @@ def extract_next_data_from_html(html: str) -> dict:
     return {}
 
 
+def create_next_data_url(base_url: str, build_id: str, path: str) -> str:
+    """
+    ページのパスから、 Next.js がそのページのデータを JSON で返す URL を作成する
+    例: /compatible_organizations/123?x=1 -> {base_url}/_next/data/{build_id}/compatible_organizations/123.json?x=1
+    """
+    path, _, query = path.partition("?")
+    if path in ("", "/"):
+        path = "/index"
+    url = f"{base_url}/_next/data/{build_id}{path}.json"
+    return f"{url}?{query}" if query else url
+
+
+class NextDataRouteFetcher:
+    """
+    詳細ページのデータを、 HTML ではなく /_next/data/<buildId>/... の JSON で取るやつ。
+    buildId は最初の1社の詳細 HTML (__NEXT_DATA__) から見つけて、あとは使い回す。
+    デプロイで buildId が変わると JSON が 404 になるので、そのときは HTML で取り直しつつ buildId を見つけ直す。
+    """
+
+    def __init__(self, base_url: str) -> None:
+        self.base_url = base_url
+        self._build_id: str | None = None
+        self._lock = threading.Lock()
+
+    def fetch_location(self, url: str) -> str:
+        """
+        詳細ページ url の住所を返します。
+        """
+        build_id = self._build_id
+        if build_id is not None:
+            path = url.removeprefix(self.base_url)
+            try:
+                data = json.loads(fetch_html_with_retry(create_next_data_url(self.base_url, build_id, path)))
+                return _get_path(data, NEXT_DATA_ROUTE_LOCATION_PATH)
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
+                logger.info(f"buildId ({build_id}) が変わったっぽいので HTML で取り直す")
+                with self._lock:
+                    if self._build_id == build_id:
+                        self._build_id = None
+
+        detail_json = extract_next_data_from_html(fetch_html(url))
+        new_build_id = detail_json.get("buildId")
+        if new_build_id:
+            with self._lock:
+                if self._build_id != new_build_id:
+                    self._build_id = new_build_id
+                    logger.info(f"buildId 発見: {new_build_id}")
+        return _get_path(detail_json, NEXT_DATA_LOCATION_PATH)
+
+
 def build_organization_data(name: str, location: str, url: str) -> dict[str, str]:
     """
     組織データを構築し、CSV 用に正規化します。
@@ -1,8 +1,79 @@
+import argparse
+import logging
+import os
+import queue
 import re
+import time
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from typing import Any
 
-from bs4 import BeautifulSoup
+import pandas as pd
+from bs4 import SoupStrainer
 
 from address_similarity import calculate_address_similarity
+from row_processor import RowRecord
+from shared import (
+    FONT_URL_PATTERNS,
+    TRACKER_URL_PATTERNS,
+    UNAUTHORIZED_MARKER,
+    ChromeDriverPool,
+    CloudflareClearance,
+    HostRateLimiter,
+    InlineWorkerPool,
+    ProcessWorkerPool,
+    ReadyCondition,
+    ResourcePolicy,
+    SharedHostRateLimiter,
+    aimd_policy_from_args,
+    configure_html_parser_from_args,
+    configure_response_cache_from_args,
+    fetch_html_slowly,
+    make_soup,
+    map_unique_values,
+    resource_policy_from_args,
+    set_rate_limiter,
+)
+from task_store import TaskStore
+
+logger = logging.getLogger(__name__)
+
+# 検索ページを開く Chrome の --resource-policy site 。
+# NOTE: Cloudflare のチャレンジ (challenges.cloudflare.com の JS と CSS) は止めないように、 CSS はブロックしない。
+RESOURCE_POLICY = ResourcePolicy(
+    block_images=True,
+    blocked_url_patterns=FONT_URL_PATTERNS + TRACKER_URL_PATTERNS,
+    page_load_strategy="eager",
+)
+
+# 検索結果ページの準備おｋ判定。
+# 結果の div が出たら準備おｋ。 401 ページなら待っても無駄なのですぐ返す。
+# NOTE: 0件ページの目印は (保存したページが無くて) わからないので入れていない。 0件ページは --wait-sec で
+#       タイムアウトするまで待つ。 (タイムアウトしたページはキャッシュしないので、次の実行でもう一度取りに行く)
+SEARCH_READY_CONDITION = ReadyCondition(
+    selector="div.frame-728-orange-l",
+    no_result_texts=(UNAUTHORIZED_MARKER,),
+)
+
+
+# process_record が jn_memo に書く、時間をおいてやり直せば良くなりそうな結果。 (--task-db のときはやり直す)
+UNAUTHORIZED_MEMO = "拒否されたわ401。ｱﾁｬｰ!"
+ERROR_MEMO_PREFIX = "なんかエラー起きたわ: "
+
+
+def is_retryable_result(values: dict[str, str]) -> bool:
+    """
+    process_record の結果が、 401 かエラーで取れなかったものかどうか。
+    """
+    memo = values.get("jn_memo", "")
+    return memo == UNAUTHORIZED_MEMO or memo.startswith(ERROR_MEMO_PREFIX)
+
+
+def search_error_result(record: RowRecord, reason: str) -> tuple[RowRecord, dict[str, str]]:
+    """
+    検索しきれなかった行 (ワーカーのプロセスが死んだなど) の結果。 jn_memo にエラーとして残す。
+    """
+    return record, {"jn_memo": f"{ERROR_MEMO_PREFIX}{reason}"}
 
 
 def create_search_url(base_url: str, search_term: str) -> str:
@@ -10,6 +81,27 @@ def create_search_url(base_url: str, search_term: str) -> str:
     return f"{base_url}/searchnumber.do?number={search_term}"
 
 
+def create_search_urls(base_url: str, search_terms: pd.Series) -> pd.Series:
+    """
+    create_search_url の Series 版。 NaN は NaN のまま。
+    """
+    # NOTE: URL の形は create_search_url だけで決める。
+    return create_search_url(base_url, "") + search_terms
+
+
+# 法人格。
+_CORPORATE_TYPE_RE = re.compile(r"(株式|有限|合同)会社")
+
+# 全角英数字 -> 半角。
+_ZENKAKU_TABLE = str.maketrans(
+    "０１２３４５６７８９ＡＢＣＤＥＦＧＨＩＪＫＬＭＮＯＰＱＲＳＴＵＶＷＸＹＺａｂｃｄｅｆｇｈｉｊｋｌｍｎｏｐｑｒｓｔｕｖｗｘｙｚ",
+    "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz",
+)
+
+# 記号。
+_SYMBOLS_RE = re.compile(r"[‐\ーｰ・,、。!！?？（）()［］【】｛｝「」『』]")
+
+
 # 文字列をノーマライズする。
 # スペース除去だけ
 def remove_spaces(name: str) -> str:
@@ -19,26 +111,45 @@ def remove_spaces(name: str) -> str:
 # 文字列をノーマライズする。
 # 法人格除去だけ (スペースは残す)
 def remove_corporate_type(name: str) -> str:
-    return re.sub(r"(株式|有限|合同)会社", "", name)
+    return _CORPORATE_TYPE_RE.sub("", name)
 
 
 # 文字列をノーマライズする。
 # 全角英数字→半角 + 記号除去だけ (スペース除去なし)
 def normalize_symbols_and_zenkaku(name: str) -> str:
-    name = name.translate(
-        str.maketrans(
-            "０１２３４５６７８９ＡＢＣＤＥＦＧＨＩＪＫＬＭＮＯＰＱＲＳＴＵＶＷＸＹＺａｂｃｄｅｆｇｈｉｊｋｌｍｎｏｐｑｒｓｔｕｖｗｘｙｚ",
-            "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz",
-        )
-    )
-    return re.sub(r"[‐\ーｰ・,、。!！?？（）()［］【】｛｝「」『』]", "", name)
+    name = name.translate(_ZENKAKU_TABLE)
+    return _SYMBOLS_RE.sub("", name)
+
+
+# 上の3つの Series 版。 列まるごとに使う。 NaN は NaN のまま。
+# NOTE: 同じ値は1回しか変換しない (shared.map_unique_values)。
+def remove_spaces_series(names: pd.Series) -> pd.Series:
+    return map_unique_values(names, remove_spaces)
+
 
+def remove_corporate_type_series(names: pd.Series) -> pd.Series:
+    return map_unique_values(names, remove_corporate_type)
 
-def parse_search_results(html: str) -> list[dict]:
+
+def normalize_symbols_and_zenkaku_series(names: pd.Series) -> pd.Series:
+    return map_unique_values(names, normalize_symbols_and_zenkaku)
+
+
+# 検索結果の div の部分木だけをパースする。
+# NOTE: class="frame-728-orange-l big" みたいにクラスが複数ついていても拾う。 (class_="..." だと属性の文字列まるごとと
+#       比べるので落ちる。 soup.select("div.frame-728-orange-l") と同じ拾い方にする)
+_SEARCH_RESULT_STRAINER = SoupStrainer(
+    "div", class_=lambda value: value is not None and "frame-728-orange-l" in value.split()
+)
+
+
+def parse_search_results(html: str, parser: str | None = None, restrict: bool = True) -> list[dict]:
     """
     検索結果を解析して必要なデータを抽出
+    parser: BeautifulSoup のパーサ。 None なら shared.set_html_parser で設定したもの。
+    restrict: True なら検索結果の div の部分木だけをパースする (False は全体をパースする、もとのやり方)。
     """
-    soup = BeautifulSoup(html, "html.parser")
+    soup = make_soup(html, parse_only=_SEARCH_RESULT_STRAINER if restrict else None, parser=parser)
     results = []
 
     # 検索結果のメインコンテナを取得
@@ -116,3 +227,167 @@ def split_tel_field(tel_field: str) -> tuple[str, str]:
         parts = [p.strip() for p in tel_field.split("|")]
         return (parts[0], parts[1] if len(parts) > 1 else "")
     return (tel_field.strip(), "")
+
+
+def build_match_columns(best_match: dict, base_url: str) -> dict[str, str]:
+    """
+    いちばん一致した検索結果を、出力 CSV の jn_* 列の値にする。
+    """
+    tel_no_hyphen, tel_hyphen = split_tel_field(best_match.get("tel", ""))
+    return {
+        "jn_tel": tel_no_hyphen,
+        "jn_tel_hyphen": tel_hyphen,
+        "jn_company_name": best_match.get("company_name", ""),
+        "jn_location": best_match.get("location", ""),
+        "jn_detail_url": base_url + "/" + best_match.get("detail_url", ""),
+    }
+
+
+@contextmanager
+def search_worker(
+    worker_id: int,
+    args: argparse.Namespace,
+    rate_limiter: Any,
+    process_record: Callable[[RowRecord, Callable[[str], str], str], dict[str, str]],
+) -> Iterator[Callable[[RowRecord], tuple[RowRecord, dict[str, str]]]]:
+    """
+    mkmk_help_2 / mkmk_help_3 の、1プロセスぶんの検索の準備。
+    Chrome を1個用意して、「record -> (record, jn_* 列の値)」の関数を渡す。 with を抜けると Chrome は quit される。
+    args: --jn-base-url, --output-csv, --workers, --wait-sec, --recycle-after, --cf-handoff, --resource-policy,
+    キャッシュとパーサの引数。
+    NOTE: shared.ProcessWorkerPool の worker_context としても使う。 --workers が 2 以上なら、
+    プロセスごとに別の Chrome プロファイル (<output_csv>.profiles/worker-N) を使う。
+    """
+    configure_response_cache_from_args(args)
+    configure_html_parser_from_args(args)
+    set_rate_limiter(rate_limiter)
+    profile_dir = os.path.join(f"{args.output_csv}.profiles", f"worker-{worker_id}") if args.workers > 1 else None
+
+    # Chrome は1回起動したら使い回す。 with を抜けるとき (例外でも) に必ず quit される。
+    with ChromeDriverPool(
+        size=1,
+        max_pages_per_driver=args.recycle_after,
+        user_data_dir=profile_dir,
+        resource_policy=resource_policy_from_args(args, RESOURCE_POLICY),
+    ) as pool:
+        # --cf-handoff のときは、 Cloudflare を突破した cookie で素の HTTP を使う。
+        clearance = CloudflareClearance(pool) if args.cf_handoff else None
+
+        def fetch(search_url: str) -> str:
+            # HTML を取得します。 検索結果が出たらすぐ次へ (最大 wait_sec 秒待つ)。
+            if clearance is not None:
+                return clearance.fetch(search_url, wait_sec=args.wait_sec, ready=SEARCH_READY_CONDITION)
+            return fetch_html_slowly(search_url, wait_sec=args.wait_sec, pool=pool, ready=SEARCH_READY_CONDITION)
+
+        yield lambda record: (record, process_record(record, fetch, args.jn_base_url))
+
+
+@contextmanager
+def open_search_pool(
+    args: argparse.Namespace,
+    process_record: Callable[[RowRecord, Callable[[str], str], str], dict[str, str]],
+) -> Iterator[InlineWorkerPool | ProcessWorkerPool]:
+    """
+    検索するワーカーとレートリミッタを1回だけ用意して、 submit(record) / get() -> (record, jn_* 列の値) で使わせる。
+    --workers が 1 ならこのプロセスで順番に、 2 以上ならその数のプロセス (それぞれ Chrome 1個) で、終わった順に返す。
+    --rps はホストごとの上限で、プロセスをまたいで全体で守る。
+    --max-rps があれば、そのレートを拒否されるまで自動で上げる。 (覚えたレートは with を抜けるまで使い続ける)
+    """
+    if args.workers <= 1:
+        rate_limiter = HostRateLimiter(rps=args.rps, aimd=aimd_policy_from_args(args))
+        with search_worker(0, args, rate_limiter, process_record) as handle:
+            yield InlineWorkerPool(handle)
+        return
+
+    # NOTE: 全プロセスで1個のレートリミッタを共有する。
+    rate_limiter = SharedHostRateLimiter(rps=args.rps, aimd=aimd_policy_from_args(args))
+    with ProcessWorkerPool(
+        search_worker, (args, rate_limiter, process_record), args.workers, error_result=search_error_result
+    ) as pool:
+        yield pool
+
+
+def iter_search_results(
+    records: Iterable[RowRecord],
+    args: argparse.Namespace,
+    process_record: Callable[[RowRecord, Callable[[str], str], str], dict[str, str]],
+) -> Iterator[tuple[RowRecord, dict[str, str]]]:
+    """
+    records を1行ずつ検索して、 (record, jn_* 列の値) を返します。 (ワーカーは open_search_pool)
+    NOTE: 同時に抱える行はワーカー数の2倍までなので、 records がジェネレータでも全部は読み込まない。
+    """
+    with open_search_pool(args, process_record) as pool:
+        for record in records:
+            pool.submit(record)
+            if len(pool) >= max(1, args.workers) * 2:
+                yield pool.get()
+        while len(pool):
+            yield pool.get()
+
+
+def search_task_key(record: RowRecord) -> str:
+    """
+    --task-db のタスクの key 。検索 URL と、検索結果から1件を選ぶのに使う列 (名前・住所) で決める。
+    NOTE: 行番号で決めると、別の CSV で同じ db を使ったときに、別の会社の結果を返してしまう。
+    同じ key の行 (同じ会社が何行もあるとか) は1回だけ検索して、結果を全部の行に返す。
+    """
+    return f"{record.search_url}\t{record.name}\t{record.location}"
+
+
+def iter_search_tasks(
+    store: TaskStore,
+    records: Iterable[RowRecord],
+    args: argparse.Namespace,
+    process_record: Callable[[RowRecord, Callable[[str], str], str], dict[str, str]],
+) -> Iterator[tuple[RowRecord, dict[str, str]]]:
+    """
+    iter_search_results の --task-db 版。 records を store に (まだ無ければ) 入れて、 pending が無くなるまで処理する。
+    タスクは search_task_key ごと。 (同じ key の行はまとめて1回だけ検索する)
+    401 やエラーの行 (is_retryable_result) は store.fail でバックオフつきでやり直し待ちにして、
+    処理していい時刻になったら、 CSV を読み直さずにこのまま続けてやり直す。
+    NOTE: 前回までに done / failed になった行はやらずに、 store が覚えている結果を最初に返す。
+    結果はやり直すたびに (最後の1回まで) 返す。
+    """
+    records_by_key: dict[str, list[RowRecord]] = {}
+    for record in records:
+        records_by_key.setdefault(search_task_key(record), []).append(record)
+    added = store.add_many((key, rows[0].search_url) for key, rows in records_by_key.items())
+    # NOTE: 同じ db に別の CSV のタスクがあっても、今回の key のタスクだけを取る・待つ。
+    store.set_scope(records_by_key)
+    logger.info(f"タスク追加おｋ: {added} 件 (状態: {store.counts()})")
+    for key, values in store.finished_results():
+        for record in records_by_key.get(key, ()):
+            yield record, values
+
+    # NOTE: ワーカー (Chrome とレートリミッタ) は最初に1回だけ用意して、やり直しもそこに流す。
+    # (やり直しのたびに作り直すと、 401 で下げたレートを忘れてしまう)
+    with open_search_pool(args, process_record) as pool:
+        while True:
+            for task in store.claim():
+                pool.submit(records_by_key[task.key][0])
+            next_eligible_at = store.next_eligible_at()
+            if not len(pool):
+                if next_eligible_at is None:
+                    break
+                wait = max(0.0, next_eligible_at - time.time())
+                logger.info(f"やり直し待ち: {wait:.0f} 秒後 (状態: {store.counts()})")
+                time.sleep(wait)
+                continue
+
+            # NOTE: 結果を待っている間にやり直しの時刻が来たら、いったん claim しに戻る。
+            timeout = None if next_eligible_at is None else max(0.0, next_eligible_at - time.time())
+            try:
+                record, values = pool.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            # NOTE: やり直しでうまくいったとき、前回の 401 やエラーの jn_memo が残らないように空にしておく。
+            values = {"jn_memo": "", **values}
+            key = search_task_key(record)
+            if is_retryable_result(values):
+                store.fail(key, values["jn_memo"], result=values)
+            else:
+                store.complete(key, result=values)
+            for row in records_by_key[key]:
+                yield row, values
+
+    logger.info(f"タスクおわり (状態: {store.counts()})")
@@ -0,0 +1,94 @@
+"""
+targets CSV (例: mkmk_help.py の出力) の各行に、候補 CSV (例: jn の検索結果をためたもの) の中から
+住所がいちばん似ている行をくっつける。
+
+pipenv run python join_by_address.py --targets-csv mkmk_help_1.csv --candidates-csv jn_dump.csv --output-csv joined.csv
+"""
+
+import argparse
+import logging
+import time
+
+import pandas as pd
+
+from address_index import AddressIndex
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+
+def join_by_address(
+    targets_df: pd.DataFrame,
+    candidates_df: pd.DataFrame,
+    target_location_column: str = "location",
+    candidate_location_column: str = "location",
+    prefix: str = "match_",
+    threshold: float = 0.7,
+) -> pd.DataFrame:
+    """
+    targets_df の右に、いちばん似ている候補の列 (prefix つき) と、類似度の列 (prefix + "address_score") を足して返す。
+    閾値に届かなかった行は、候補の列が空になる。
+    """
+    index = AddressIndex(candidates_df.to_dict("records"), location_key=candidate_location_column, threshold=threshold)
+    logger.info(f"インデックス作成おｋ: {len(index)} 件")
+
+    started = time.perf_counter()
+    matches = index.match_all(targets_df[target_location_column])
+    elapsed = time.perf_counter() - started
+    logger.info(
+        f"照合おｋ: {len(matches)} 件, {elapsed:.3f}秒, "
+        f"比較回数 {index.comparisons} (全件比べると {len(matches) * len(index)})"
+    )
+
+    empty = dict.fromkeys(candidates_df.columns, "")
+    matched_df = pd.DataFrame([candidate if candidate is not None else empty for candidate, _ in matches])
+    matched_df = matched_df.reindex(columns=candidates_df.columns).add_prefix(prefix)
+    matched_df[f"{prefix}address_score"] = [score for _, score in matches]
+    matched_df.index = targets_df.index
+    return pd.concat([targets_df, matched_df], axis=1)
+
+
+def main() -> None:
+    logger.info("start join_by_address")
+
+    parser = argparse.ArgumentParser(description="2つの CSV を住所の類似度でくっつける")
+    parser.add_argument("--targets-csv", required=True, help="くっつけられる側の CSV ファイルパス")
+    parser.add_argument("--candidates-csv", required=True, help="候補の CSV ファイルパス")
+    parser.add_argument("--output-csv", required=True, help="出力 CSV ファイルパス")
+    parser.add_argument("--target-location-column", default="location", help="targets CSV の住所の列")
+    parser.add_argument("--candidate-location-column", default="location", help="候補 CSV の住所の列")
+    parser.add_argument("--prefix", default="match_", help="くっつける候補の列につける接頭辞")
+    parser.add_argument("--threshold", type=float, default=0.7, help="これ未満の類似度ならくっつけない")
+    args = parser.parse_args()
+
+    # NOTE: 電話番号の先頭の 0 が消えたりしないように、ぜんぶ文字列で読む。
+    targets_df = pd.read_csv(args.targets_csv, dtype=str, keep_default_na=False)
+    logger.info(f"targets CSV 読み込みおｋ: {args.targets_csv} ({len(targets_df)} 行)")
+    candidates_df = pd.read_csv(args.candidates_csv, dtype=str, keep_default_na=False)
+    logger.info(f"候補 CSV 読み込みおｋ: {args.candidates_csv} ({len(candidates_df)} 行)")
+
+    for column, df, name in [
+        (args.target_location_column, targets_df, "targets CSV"),
+        (args.candidate_location_column, candidates_df, "候補 CSV"),
+    ]:
+        if column not in df.columns:
+            logger.error(f"{name} に '{column}' 列がありません")
+            return
+
+    joined_df = join_by_address(
+        targets_df,
+        candidates_df,
+        target_location_column=args.target_location_column,
+        candidate_location_column=args.candidate_location_column,
+        prefix=args.prefix,
+        threshold=args.threshold,
+    )
+    joined_df.to_csv(args.output_csv, index=False, encoding="utf_8_sig")
+    matched = (joined_df[f"{args.prefix}address_score"] >= args.threshold).sum()
+    logger.info(f"出力おｋ: {args.output_csv} ({matched}/{len(joined_df)} 行がくっついた)")
+
+    logger.info("end join_by_address")
+
+
+if __name__ == "__main__":
+    main()
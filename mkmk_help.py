@@ -1,12 +1,44 @@
 import argparse
+import csv
+import json
 import logging
-from time import sleep
+import math
+import os
+from collections.abc import Iterable, Iterator
+from functools import partial
 
-from jb import build_organization_data, extract_next_data_from_html, extract_organizations_from_html
+from jb import (
+    DETAIL_PATH_TEMPLATE,
+    LIST_API_URL_FILTER,
+    LIST_READY_CONDITION,
+    NEXT_DATA_LOCATION_PATH,
+    RESOURCE_POLICY,
+    NextDataRouteFetcher,
+    build_organization_data,
+    create_list_url,
+    extract_next_data_value,
+    extract_organizations_from_html,
+    extract_organizations_from_payloads,
+)
+from output_writers import CsvStreamWriter, read_written_urls
 from shared import (
+    ChromeDriverPool,
+    HostRateLimiter,
+    add_adaptive_rate_arguments,
+    add_cache_arguments,
+    add_html_parser_argument,
+    add_resource_policy_argument,
+    aimd_policy_from_args,
+    configure_html_parser_from_args,
+    configure_http_session,
+    configure_response_cache_from_args,
     fetch_html,
+    fetch_html_if_modified,
     fetch_html_slowly,
-    save_to_csv,
+    fetch_network_json_slowly,
+    map_concurrently,
+    resource_policy_from_args,
+    set_rate_limiter,
     show_progress_with_name,
 )
 
@@ -14,6 +46,211 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
 
+def fetch_organization_detail(
+    org: dict[str, str], next_data_fetcher: NextDataRouteFetcher | None = None
+) -> dict[str, str]:
+    """
+    1社ぶんの詳細画面にアクセスして、 {name, location, url} を作ります。
+    一覧 API の JSON に住所が載っていたなら、詳細画面にはアクセスしない。
+    next_data_fetcher を渡すと、詳細 HTML ではなく /_next/data/... の JSON で住所を取る。
+    """
+    if "location" in org:
+        return build_organization_data(name=org["name"], location=org["location"], url=org["url"])
+
+    if next_data_fetcher is not None:
+        location = next_data_fetcher.fetch_location(org["url"])
+        return build_organization_data(name=org["name"], location=location, url=org["url"])
+
+    detail_html: str = fetch_html(org["url"])
+    # print(detail_html)
+    # NOTE: __NEXT_DATA__ 全体を見たいなら extract_next_data_from_html(detail_html) を print する。
+    location: str = extract_next_data_value(detail_html, NEXT_DATA_LOCATION_PATH)
+    # NOTE: 順番を変えたいだけ。
+    return build_organization_data(name=org["name"], location=location, url=org["url"])
+
+
+# --previous-csv の差分モードで、前回の行と比べた結果。 unchanged 以外を changes CSV に書く。
+DELTA_CHANGES = ("added", "modified", "unchanged")
+
+
+def load_previous_output(previous_csv: str) -> dict[str, dict[str, str]]:
+    """
+    前回の出力 CSV を {url: {name, location, url}} にして返します。
+    """
+    # NOTE: BOM つきでもなしでも読めるように utf-8-sig 。
+    with open(previous_csv, encoding="utf-8-sig", newline="") as f:
+        return {
+            row["url"]: {"name": row["name"], "location": row["location"], "url": row["url"]}
+            for row in csv.DictReader(f)
+        }
+
+
+def validators_path(output_csv: str) -> str:
+    """
+    出力 CSV の各 URL の ETag / Last-Modified を置いておくファイル。 (次回の --previous-csv で使う)
+    """
+    return f"{output_csv}.validators.json"
+
+
+def load_validators(output_csv: str) -> dict[str, dict[str, str]]:
+    path = validators_path(output_csv)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_validators(output_csv: str, validators: dict[str, dict[str, str]]) -> None:
+    path = validators_path(output_csv)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(validators, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def fetch_organization_delta(
+    org: dict[str, str],
+    previous_rows: dict[str, dict[str, str]],
+    previous_validators: dict[str, dict[str, str]],
+    next_data_fetcher: NextDataRouteFetcher | None = None,
+) -> tuple[dict[str, str], str, dict[str, str]]:
+    """
+    fetch_organization_detail の差分モード版。 (行, 前回との違い (DELTA_CHANGES), 次回用の validator) を返します。
+    前回もあった URL の詳細 HTML は、前回の ETag / Last-Modified で条件つき GET して、 304 なら前回の住所を使う。
+    NOTE: 一覧 API に住所が載っているときや、 next_data_fetcher を使うときは、今までどおり取って前回と比べるだけ。
+    NOTE: 差分モードでないときも、 previous_rows={} で呼んで次回用の validator をもらう。
+    """
+    url = org["url"]
+    previous = previous_rows.get(url)
+    validators = previous_validators.get(url, {})
+    if "location" in org or next_data_fetcher is not None:
+        row = fetch_organization_detail(org, next_data_fetcher)
+    else:
+        # NOTE: 新しい URL は validator なし (ふつうの GET) 。次回のために validator だけもらっておく。
+        if previous is None:
+            validators = {}
+        result = fetch_html_if_modified(url, validators.get("etag", ""), validators.get("last_modified", ""))
+        validators = {"etag": result.etag, "last_modified": result.last_modified}
+        if result.html is None:
+            logger.info(f"変わってない (304): {url}")
+            row = build_organization_data(name=org["name"], location=previous["location"], url=url)
+        else:
+            location: str = extract_next_data_value(result.html, NEXT_DATA_LOCATION_PATH)
+            row = build_organization_data(name=org["name"], location=location, url=url)
+
+    if previous is None:
+        change = "added"
+    elif row == previous:
+        change = "unchanged"
+    else:
+        change = "modified"
+    return row, change, validators
+
+
+def iter_listing_organizations(
+    base_url: str,
+    total_row: int,
+    page_size: int,
+    pool: ChromeDriverPool,
+    listing_source: str = "html",
+    detail_path_template: str = DETAIL_PATH_TEMPLATE,
+) -> Iterator[dict[str, str]]:
+    """
+    一覧を page=1..N まで page_size 件ずつ取りに行き、 {name, url} を一覧の順番で1社ずつ返します。
+    ページは pool の Chrome の数だけ並列に取りに行く。ページが届いたそばから返すので、詳細の取得をすぐ始められる。
+    ページをまたいで同じ URL が出てきたら (取得中に一覧がずれたときとか)、2回目以降は捨てる。
+    listing_source="api" なら、描画されたテーブルではなく、ページが裏で受け取った JSON から組織を作る。
+    JSON に住所が載っていれば {name, url, location} を返す。
+    """
+    page_count = math.ceil(total_row / page_size)
+
+    def fetch_page(page: int) -> list[dict[str, str]]:
+        list_url = create_list_url(base_url, page, page_size)
+        if listing_source == "api":
+            # 通信をキャプチャ。 テーブルが出たら JSON も届いてるはずなので次へ (最大 30 秒待つ)。
+            payloads = fetch_network_json_slowly(
+                list_url, wait_sec=30, pool=pool, ready=LIST_READY_CONDITION, url_filter=LIST_API_URL_FILTER
+            )
+            # [{name, path, location?}, ...]
+            organizations = extract_organizations_from_payloads(payloads, detail_path_template)
+        else:
+            # html ゲット。 テーブルが出たらすぐ次へ (最大 30 秒待つ)。
+            html: str = fetch_html_slowly(list_url, wait_sec=30, pool=pool, ready=LIST_READY_CONDITION)
+            # 会社名と、リンクをゲット。
+            # [{name, path}, ...]
+            organizations = extract_organizations_from_html(html)
+        logger.info(f"一覧 {page}/{page_count} ページ目おｋ: {len(organizations)} 社")
+        return organizations
+
+    seen_urls: set[str] = set()
+    for organizations in map_concurrently(fetch_page, range(1, page_count + 1), pool.size):
+        if not organizations:
+            logger.info("空のページが来たので一覧はここまで")
+            return
+        for org in organizations:
+            # [{name, url}, ...]
+            url = f"{base_url}{org['path']}"
+            if url in seen_urls:
+                logger.info(f"ページをまたいで重複したので捨てる: {url}")
+                continue
+            seen_urls.add(url)
+            org["url"] = url
+            del org["path"]
+            yield org
+            if len(seen_urls) >= total_row:
+                return
+
+
+def write_delta(
+    args: argparse.Namespace,
+    organizations: Iterable[dict[str, str]],
+    previous_rows: dict[str, dict[str, str]],
+    previous_validators: dict[str, dict[str, str]],
+    next_data_fetcher: NextDataRouteFetcher | None,
+    writer: CsvStreamWriter,
+) -> None:
+    """
+    差分モードの本体。一覧の組織を fetch_organization_delta して、ぜんぶ writer (output_csv) に書き、
+    added / modified の行だけ changes CSV にも書く (次の mkmk_help_2 にはこっちを渡せば、変わった行だけ検索する)。
+    前回あって今回の一覧に無い組織は、 output_csv に書かない (消える)。
+    validator は (途中で落ちても) <output_csv>.validators.json に書いておく。
+    """
+    changes_csv = args.changes_csv or f"{args.output_csv}.changes.csv"
+    fetch_delta = partial(
+        fetch_organization_delta,
+        previous_rows=previous_rows,
+        previous_validators=previous_validators,
+        next_data_fetcher=next_data_fetcher,
+    )
+    counts = dict.fromkeys(DELTA_CHANGES, 0)
+    validators: dict[str, dict[str, str]] = {}
+    seen_urls: set[str] = set()
+    results = map_concurrently(fetch_delta, organizations, args.concurrency)
+    with CsvStreamWriter(changes_csv, ["name", "location", "url", "change"]) as changes_writer:
+        try:
+            for i, (org, change, org_validators) in enumerate(results):
+                writer.write(org)
+                if change != "unchanged":
+                    changes_writer.write({**org, "change": change})
+                if any(org_validators.values()):
+                    validators[org["url"]] = org_validators
+                counts[change] += 1
+                seen_urls.add(org["url"])
+                show_progress_with_name(i + 1, args.total_row, org["name"])
+        finally:
+            save_validators(args.output_csv, validators)
+
+    removed = [url for url in previous_rows if url not in seen_urls]
+    for url in removed:
+        logger.info(f"一覧から消えたので捨てる: {url}")
+    # NOTE: 改行のため
+    print()
+    logger.info(
+        f"差分おｋ: 追加 {counts['added']}, 変更 {counts['modified']}, 変更なし {counts['unchanged']}, "
+        f"削除 {len(removed)} (changes CSV: {changes_csv})"
+    )
+
+
 def main() -> None:
     logger.info("start mkmk_help")
 
@@ -21,47 +258,121 @@ def main() -> None:
     parser.add_argument("--base-url", default="", help="Base url")
     parser.add_argument("--total-row", type=int, default=1, help="Number of rows to fetch")
     parser.add_argument("--output-csv", default="mkmk.csv", help="Output CSV file path (UTF-8 with BOM) ")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of detail pages fetched in parallel")
+    parser.add_argument("--rps", type=float, default=2.0, help="Max requests per second per host")
+    parser.add_argument(
+        "--page-size", type=int, default=None, help="Rows per listing page (default: all rows on one page)"
+    )
+    parser.add_argument(
+        "--browser-pool-size", type=int, default=1, help="Number of headless Chrome fetching listing pages"
+    )
+    parser.add_argument(
+        "--listing-source",
+        choices=("html", "api"),
+        default="html",
+        help="Read the listing from the rendered table (html) or from the JSON the page fetches (api)",
+    )
+    parser.add_argument(
+        "--detail-path-template",
+        default=DETAIL_PATH_TEMPLATE,
+        help="Detail page path built from an organization id in --listing-source api mode",
+    )
+    parser.add_argument(
+        "--detail-source",
+        choices=("html", "next-data"),
+        default="html",
+        help="Fetch detail pages as HTML or as Next.js /_next/data/<buildId>/... JSON",
+    )
+    parser.add_argument(
+        "--resume", action="store_true", help="Append to --output-csv and skip detail pages already fetched"
+    )
+    parser.add_argument(
+        "--previous-csv",
+        default=None,
+        help="Previous output of this script; fetch details only for new URLs, revalidate the rest "
+        "with conditional GETs, and drop organizations no longer listed",
+    )
+    parser.add_argument(
+        "--changes-csv",
+        default=None,
+        help="Where --previous-csv mode writes the added/modified rows (default: <output-csv>.changes.csv)",
+    )
+    add_adaptive_rate_arguments(parser)
+    add_cache_arguments(parser)
+    add_html_parser_argument(parser)
+    add_resource_policy_argument(parser)
     args = parser.parse_args()
+    if args.previous_csv and args.resume:
+        parser.error("--previous-csv と --resume はいっしょに使えないよ")
+    configure_response_cache_from_args(args)
+    configure_html_parser_from_args(args)
     base_url = args.base_url
     # メッチャおもろいんだけど一度の表示件数をコッチで決めれるｗ
     total_row = args.total_row
     output_csv = args.output_csv
 
-    list_url = f"{base_url}/compatible_organizations?page=1&standards=140012015&pageSize={total_row}&nationality=JPN&classification=28"  # noqa: E501
-
-    # html ゲット。
-    html: str = fetch_html_slowly(list_url, wait_sec=3)
-
-    # 会社名と、リンクをゲット。
-    # [{name, path}, ...]
-    organizations: list[dict[str, str]] = extract_organizations_from_html(html)
-    for org in organizations:
-        # [{name, url}, ...]
-        org["url"] = f"{base_url}{org['path']}"
-        del org["path"]
-
-    for i, org in enumerate(organizations):
-        # 1社ずつ詳細画面にアクセス。
-        detail_html: str = fetch_html(org["url"])
-        # print(detail_html)
-        detail_json: dict = extract_next_data_from_html(detail_html)
-        # print(detail_json) # <-- json みたいならこれ
-        # NOTE: 順番を変えたいだけ。
-        # [{name, location, url}, ...]
-        org = build_organization_data(
-            name=org["name"],
-            location=detail_json["props"]["pageProps"]["organization"]["attributes"]["location"],
-            url=org["url"],
-        )
-        organizations[i] = org
-        show_progress_with_name(i + 1, len(organizations), org["name"])
-        # NOTE: 連続アクセスをやめようか。
-        sleep(0.5)
+    # NOTE: 連続アクセスの間隔はレートリミッタだけで守る。
+    # --max-rps を指定すると、ホストごとのレートを拒否されるまで自動で上げていく。
+    set_rate_limiter(HostRateLimiter(rps=args.rps, aimd=aimd_policy_from_args(args)))
+    configure_http_session(pool_size=max(10, args.concurrency))
 
-    # NOTE: 改行のため
-    print()
+    # NOTE: --page-size を指定しなければ、これまでどおり1ページに total_row 件ぜんぶ出す。
+    page_size = args.page_size or total_row
+
+    # --previous-csv なら差分モード。前回の行と validator は、 output_csv を開く (空にする) 前に読んでおく。
+    # NOTE: 一覧に出てこなくなった組織は消えたとみなすので、 --total-row は前回と同じ (か、全件より多く) にすること。
+    previous_rows: dict[str, dict[str, str]] = {}
+    previous_validators: dict[str, dict[str, str]] = {}
+    if args.previous_csv:
+        previous_rows = load_previous_output(args.previous_csv)
+        previous_validators = load_validators(args.previous_csv)
+        logger.info(f"前回の出力を読み込み: {len(previous_rows)} 社, validator {len(previous_validators)} 件")
 
-    save_to_csv(organizations, output_csv)
+    # 一覧のページが届いたそばから、1社ずつ詳細画面にアクセス。
+    # --concurrency 社ずつ並列に取りに行くけど、結果は一覧の順番で返ってくる。
+    # 1社できるたびに CSV に追記するので、途中で落ちてもそこまでの結果は残る。
+    # [{name, location, url}, ...]
+    with (
+        ChromeDriverPool(
+            size=args.browser_pool_size,
+            capture_network=args.listing_source == "api",
+            resource_policy=resource_policy_from_args(args, RESOURCE_POLICY),
+        ) as pool,
+        CsvStreamWriter(output_csv, ["name", "location", "url"], append=args.resume) as writer,
+    ):
+        # --resume なら、 output_csv にもう書いてある URL は飛ばす。
+        # NOTE: writer を開いて、書きかけの最終行を捨ててから読むこと。
+        done_urls = read_written_urls(output_csv) if args.resume else set()
+        done_before = len(done_urls)
+        if args.resume:
+            logger.info(f"再開: 取得済みの {done_before} 社はスキップ")
+
+        organizations = iter_listing_organizations(
+            base_url, total_row, page_size, pool, args.listing_source, args.detail_path_template
+        )
+        pending = (org for org in organizations if org["url"] not in done_urls)
+        next_data_fetcher = NextDataRouteFetcher(base_url) if args.detail_source == "next-data" else None
+        if args.previous_csv:
+            write_delta(args, pending, previous_rows, previous_validators, next_data_fetcher, writer)
+        else:
+            # NOTE: 次回 --previous-csv で条件つき GET できるように、詳細 HTML の validator も残しておく。
+            validators = load_validators(output_csv) if args.resume else {}
+            fetch_detail = partial(
+                fetch_organization_delta,
+                previous_rows={},
+                previous_validators={},
+                next_data_fetcher=next_data_fetcher,
+            )
+            try:
+                for i, (org, _, org_validators) in enumerate(map_concurrently(fetch_detail, pending, args.concurrency)):
+                    writer.write(org)
+                    if any(org_validators.values()):
+                        validators[org["url"]] = org_validators
+                    show_progress_with_name(done_before + i + 1, total_row, org["name"])
+            finally:
+                save_validators(output_csv, validators)
+            # NOTE: 改行のため
+            print()
 
     logger.info("end mkmk_help")
 
@@ -1,16 +1,63 @@
 import argparse
 import logging
-from time import sleep
+from collections.abc import Callable
+from contextlib import ExitStack, closing
 
 import pandas as pd
 
 import jn
 import shared
+from output_writers import RowJournal, input_fingerprint
+from row_processor import RowRecord, iter_row_records
+from task_store import add_task_store_arguments, open_task_store_from_args
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
 
+def process_record(record: RowRecord, fetch: Callable[[str], str], base_url: str) -> dict[str, str]:
+    """
+    1行ぶんの処理。名前で検索して、住所がいちばん近い結果を jn_* 列の値にして返す。
+    """
+    idx = record.idx
+    search_url = record.search_url
+    try:
+        # HTML を取得します。 検索結果が出たらすぐ次へ (最大 10 秒待つ)。
+        # NOTE: アクセスの間隔はレートリミッタ (--rps, --max-rps) だけで守る。ここでは寝ない。
+        html = fetch(search_url)
+
+        if "401 Error - Unauthorized Access" in html:
+            logger.error(f"[{idx}] アクセスが拒否 (401) されました: {search_url}")
+            return {"jn_memo": jn.UNAUTHORIZED_MEMO}
+
+        # デバッグ用に HTML をファイルに保存します。
+        # debug_filename = "debug_output.html"
+        # with open(debug_filename, "w", encoding="utf-8") as f:
+        #     f.write(html)
+        # logger.info(f"デバッグ用 HTML を保存: {debug_filename}")
+
+        # HTML から検索結果の一覧を取得する
+        search_results = jn.parse_search_results(html)
+
+        logger.info(f"[{idx}] 検索結果の取得おｋ: {len(search_results)} 件")
+
+        # 一覧の中から、もっとも適切っぽいものを選ぶ。
+        # "もっとも適切っぽい":
+        #     csv から取得した住所と、 html から取得した住所 -> 正規化 -> 比較
+        best_match = jn.find_best_match_by_location(search_results, record.location)
+
+        # それを csv へ!
+        if best_match:
+            logger.info(f"[{idx}] 最適な一致を見つけた: {best_match}")
+            return jn.build_match_columns(best_match, base_url)
+
+        logger.warning(f"[{idx}] 最適な一致が見つからなかった。")
+        return {"jn_memo": "なんかこれは見つからなかったわ。検索 URL つけたからそれ見てみて。"}
+    except Exception as e:
+        logger.error(f"[{idx}] 処理中にエラー: {e}")
+        return {"jn_memo": f"{jn.ERROR_MEMO_PREFIX}{str(e)}"}
+
+
 def main() -> None:
     logger.info("start mkmk_help_2")
 
@@ -18,6 +65,24 @@ def main() -> None:
     parser.add_argument("--csv", required=True, help="Input CSV path")
     parser.add_argument("--jn-base-url", required=True, help="Base URL for jn search")
     parser.add_argument("--output-csv", default="mkmk.csv", help="Output CSV file path (UTF-8 with BOM) ")
+    parser.add_argument("--wait-sec", type=int, default=10, help="Max seconds to wait for search results")
+    parser.add_argument(
+        "--recycle-after", type=int, default=50, help="Restart the headless Chrome after this many pages"
+    )
+    parser.add_argument(
+        "--cf-handoff",
+        action="store_true",
+        help="Solve the Cloudflare challenge once in Chrome, then fetch pages over plain HTTP with its cookies",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of processes searching in parallel (one Chrome each)"
+    )
+    parser.add_argument("--rps", type=float, default=2.0, help="Max requests per second per host (all workers)")
+    shared.add_adaptive_rate_arguments(parser)
+    add_task_store_arguments(parser)
+    shared.add_cache_arguments(parser)
+    shared.add_html_parser_argument(parser)
+    shared.add_resource_policy_argument(parser)
     args = parser.parse_args()
     base_url = args.jn_base_url
     output_csv = args.output_csv
@@ -36,10 +101,10 @@ def main() -> None:
 
     # 検索ワード (次項で使う) を作成します。
     # NOTE: いまのところ、スペース除去のみがもっとも適切そう。
-    df_sub["name_no_space"] = df_sub["name"].apply(jn.remove_spaces)
+    df_sub["name_no_space"] = jn.remove_spaces_series(df_sub["name"])
 
     # 検索 URL の列を追加 (ここでは name_no_space を使う例)
-    df_sub["jn_search_url"] = df_sub["name_no_space"].apply(lambda x: jn.create_search_url(base_url, x))
+    df_sub["jn_search_url"] = jn.create_search_urls(base_url, df_sub["name_no_space"])
 
     # この状態で csv に保存する。
     df_sub.to_csv("mkmk_help_2_jn_search_url.csv", index=False, encoding="utf_8_sig")
@@ -52,61 +117,33 @@ def main() -> None:
     df_sub["jn_detail_url"] = ""
     df_sub["jn_memo"] = ""
 
-    for idx, row in df_sub.iterrows():
-        search_url = row["jn_search_url"]
-        test_location = row["location"]
-
-        try:
-            # HTML を取得します。
-            html = shared.fetch_html_slowly(search_url, wait_sec=10)
-            # NOTE: 連続アクセスをやめようか。
-            sleep(0.5)
-
-            if '401 Error - Unauthorized Access' in html:
-                logger.error(f"[{idx}] アクセスが拒否 (401) されました: {search_url}")
-                df_sub.at[idx, "jn_memo"] = "拒否されたわ401。ｱﾁｬｰ!"
-                continue
-
-            # デバッグ用に HTML をファイルに保存します。
-            # debug_filename = "debug_output.html"
-            # with open(debug_filename, "w", encoding="utf-8") as f:
-            #     f.write(html)
-            # logger.info(f"デバッグ用 HTML を保存: {debug_filename}")
-
-            # HTML から検索結果の一覧を取得する
-            search_results = jn.parse_search_results(html)
-
-            logger.info(f"[{idx}] 検索結果の取得おｋ: {len(search_results)} 件")
-
-            # 一覧の中から、もっとも適切っぽいものを選ぶ。
-            # "もっとも適切っぽい":
-            #     csv から取得した住所と、 html から取得した住所 -> 正規化 -> 比較
-            best_match = jn.find_best_match_by_location(search_results, test_location)
-
-            # それを csv へ!
-            if best_match:
-                logger.info(f"[{idx}] 最適な一致を見つけた: {best_match}")
-
-                tel_raw = best_match.get("tel", "")
-                tel_no_hyphen, tel_hyphen = jn.split_tel_field(tel_raw)
-
-                df_sub.at[idx, "jn_tel"] = tel_no_hyphen
-                df_sub.at[idx, "jn_tel_hyphen"] = tel_hyphen
-                df_sub.at[idx, "jn_company_name"] = best_match.get("company_name", "")
-                df_sub.at[idx, "jn_location"] = best_match.get("location", "")
-                df_sub.at[idx, "jn_detail_url"] = base_url + "/" + best_match.get("detail_url", "")
-            else:
-                logger.warning(f"[{idx}] 最適な一致が見つからなかった。")
-                df_sub.at[idx, "jn_memo"] = "なんかこれは見つからなかったわ。検索 URL つけたからそれ見てみて。"
-
-            # NOTE: 無効なときがたくさんあるから、処理ごとに保存することにした。
-            df_sub.to_csv(output_csv, index=False, encoding="utf_8_sig")
-        except Exception as e:
-            df_sub.at[idx, "jn_memo"] = f"なんかエラー起きたわ: {str(e)}"
-            logger.error(f"[{idx}] 処理中にエラー: {e}")
-
-        # 進捗を表示。
-        shared.show_progress_with_name(idx + 1, len(df_sub), row["name"])
+    # 結果はジャーナルに追記していき、 with を抜けるとき (Ctrl+C でも) に output_csv にまとめる。
+    # NOTE: 前回が途中で終わっていたら (ジャーナルが残っていたら)、ジャーナルにある行はスキップして続きからやる。
+    fingerprint = input_fingerprint("mkmk_help_2", args.csv, df_sub["url"])
+    with RowJournal(df_sub, output_csv, fingerprint) as journal, ExitStack() as stack:
+        if args.task_db:
+            # --task-db なら、どの行をやるかは TaskStore が決める。 (done の行はやらない。 401 やエラーの行はやり直す)
+            store = stack.enter_context(open_task_store_from_args(args))
+            skipped = 0
+            results = jn.iter_search_tasks(store, iter_row_records(df_sub), args, process_record)
+        else:
+            pending = [record for record in iter_row_records(df_sub) if record.idx not in journal]
+            skipped = len(df_sub) - len(pending)
+            if skipped:
+                logger.info(f"再開: 処理済みの {skipped} 行はスキップ")
+            # --workers 2 以上なら、行をプロセスに振り分けて並列に検索する。結果は終わった順に来る。
+            results = jn.iter_search_results(pending, args, process_record)
+
+        # NOTE: --task-db だと同じ行が (やり直しで) 何回か来るので、行の数で数える。
+        finished: set[int] = set()
+        with closing(results):
+            for record, values in results:
+                # NOTE: 無効なときがたくさんあるから、処理ごとにジャーナルへ保存することにした。
+                journal.record(record.idx, values)
+                finished.add(record.idx)
+
+                # 進捗を表示。
+                shared.show_progress_with_name(skipped + len(finished), len(df_sub), record.name)
 
     logger.info("end mkmk_help_2")
 
@@ -1,14 +1,61 @@
 import argparse
 import logging
+from collections.abc import Callable
+from contextlib import ExitStack, closing
 
 import pandas as pd
 
 import jn
 import shared
 from name_similarity import find_best_match_by_name
+from output_writers import RowJournal, input_fingerprint
+from row_processor import RowRecord, iter_row_records
+from task_store import add_task_store_arguments, open_task_store_from_args
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s [%(levelname)s] %(message)s")
+# NOTE: shared の basicConfig (INFO) が先に走るので、上の DEBUG は効かない。
+#       名前マッチングのログは DEBUG で出したいので、 name_similarity のロガーだけ DEBUG にする。
+logging.getLogger("name_similarity").setLevel(logging.DEBUG)
+
+
+def process_record(record: RowRecord, fetch: Callable[[str], str], base_url: str) -> dict[str, str]:
+    """
+    1行ぶんの処理。住所で検索して、名前がいちばん近い結果を jn_* 列の値にして返す。
+    """
+    idx = record.idx
+    search_url = record.search_url
+    test_name = record.name
+    try:
+        logger.info(f"[{idx}] 処理開始: {test_name}")
+
+        # HTML を取得します。 検索結果が出たらすぐ次へ (最大 wait_sec 秒待つ)。
+        html = fetch(search_url)
+
+        if "401 Error - Unauthorized Access" in html:
+            logger.error(f"[{idx}] アクセスが拒否 (401) されました: {search_url}")
+            return {"jn_memo": jn.UNAUTHORIZED_MEMO}
+
+        # HTML から検索結果の一覧を取得する
+        search_results = jn.parse_search_results(html)
+
+        logger.info(f"[{idx}] 検索結果の取得おｋ: {len(search_results)} 件")
+
+        # 一覧の中から、もっとも適切っぽいものを選ぶ。
+        # Level 3: 住所で検索した結果から、名前でバリデーションする
+        best_match = find_best_match_by_name(search_results, test_name)
+
+        # それを csv へ!
+        if best_match:
+            logger.info(f"[{idx}] 最適な一致を見つけた: {best_match}")
+            return {**jn.build_match_columns(best_match, base_url), "jn_memo": "住所検索で電話番号を埋めた。"}
+
+        logger.warning(f"[{idx}] 最適な一致が見つからなかった。")
+        return {"jn_memo": "住所検索したけど見つからなかったわ。検索 URL つけたからそれ見てみて。"}
+
+    except Exception as e:
+        logger.error(f"[{idx}] 処理中にエラー: {e}")
+        return {"jn_memo": f"{jn.ERROR_MEMO_PREFIX}{str(e)}"}
 
 
 def main() -> None:
@@ -18,7 +65,24 @@ def main() -> None:
     parser.add_argument("--csv", required=True, help="Input CSV path")
     parser.add_argument("--jn-base-url", required=True, help="Base URL for jn search")
     parser.add_argument("--output-csv", default="mkmk.csv", help="Output CSV file path (UTF-8 with BOM)")
-    parser.add_argument("--wait-sec", type=int, default=10, help="Wait seconds between requests")
+    parser.add_argument("--wait-sec", type=int, default=10, help="Max seconds to wait for search results")
+    parser.add_argument(
+        "--recycle-after", type=int, default=50, help="Restart the headless Chrome after this many pages"
+    )
+    parser.add_argument(
+        "--cf-handoff",
+        action="store_true",
+        help="Solve the Cloudflare challenge once in Chrome, then fetch pages over plain HTTP with its cookies",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of processes searching in parallel (one Chrome each)"
+    )
+    parser.add_argument("--rps", type=float, default=2.0, help="Max requests per second per host (all workers)")
+    shared.add_adaptive_rate_arguments(parser)
+    add_task_store_arguments(parser)
+    shared.add_cache_arguments(parser)
+    shared.add_html_parser_argument(parser)
+    shared.add_resource_policy_argument(parser)
     args = parser.parse_args()
 
     base_url = args.jn_base_url
@@ -33,10 +97,10 @@ def main() -> None:
 
     # name_no_space の隣に location_no_space を配置
     name_no_space_idx = df.columns.get_loc("name_no_space")
-    df.insert(name_no_space_idx + 1, "location_no_space", df["location"].apply(jn.remove_spaces))
+    df.insert(name_no_space_idx + 1, "location_no_space", jn.remove_spaces_series(df["location"]))
 
     # 検索 URL の列を追加 (ここでは location_no_space を使う)
-    df["jn_search_url"] = df["location_no_space"].apply(lambda x: jn.create_search_url(base_url, x))
+    df["jn_search_url"] = jn.create_search_urls(base_url, df["location_no_space"])
 
     logger.info("検索 URL の作成おｋ")
 
@@ -48,61 +112,31 @@ def main() -> None:
     df["jn_detail_url"] = ""
     df["jn_memo"] = ""
 
-    for idx, row in df.iterrows():
-        search_url = row["jn_search_url"]
-        test_name = row["name"]
-
-        # すでに電話番号が埋まってたらスキップ (NaN と空文字列以外)
-        jn_tel_value = row.get("jn_tel", "")
-        if pd.notna(jn_tel_value) and str(jn_tel_value).strip() != "":
-            logger.info(f"[{idx}] スキップ (すでに処理済み): {test_name}")
-            continue
-
-        try:
-            logger.info(f"[{idx}] 処理開始: {test_name}")
-
-            # HTML を取得します。
-            html = shared.fetch_html_slowly(search_url, wait_sec=wait_sec)
-
-            if "401 Error - Unauthorized Access" in html:
-                logger.error(f"[{idx}] アクセスが拒否 (401) されました: {search_url}")
-                df.at[idx, "jn_memo"] = "拒否されたわ401。ｱﾁｬｰ!"
+    # 結果はジャーナルに追記していき、 with を抜けるとき (Ctrl+C でも) に output_csv にまとめる。
+    # NOTE: 前回が途中で終わっていたら、ジャーナルの中身が df に戻ってくるので、埋まった行はスキップされる。
+    fingerprint = input_fingerprint("mkmk_help_3", args.csv, df["url"])
+    with RowJournal(df, output_csv, fingerprint) as journal, ExitStack() as stack:
+        pending = []
+        for record in iter_row_records(df):
+            # すでに電話番号が埋まってたら (か、前回ジャーナルに書いた行なら) スキップ
+            # NOTE: --task-db なら、前回やったかどうかは TaskStore が決める。 (401 やエラーの行はやり直す)
+            if record.jn_tel.strip() != "" or (not args.task_db and record.idx in journal):
+                logger.info(f"[{record.idx}] スキップ (すでに処理済み): {record.name}")
                 continue
-
-            # HTML から検索結果の一覧を取得する
-            search_results = jn.parse_search_results(html)
-
-            logger.info(f"[{idx}] 検索結果の取得おｋ: {len(search_results)} 件")
-
-            # 一覧の中から、もっとも適切っぽいものを選ぶ。
-            # Level 3: 住所で検索した結果から、名前でバリデーションする
-            best_match = find_best_match_by_name(search_results, test_name)
-
-            # それを csv へ!
-            if best_match:
-                logger.info(f"[{idx}] 最適な一致を見つけた: {best_match}")
-
-                tel_raw = best_match.get("tel", "")
-                tel_no_hyphen, tel_hyphen = jn.split_tel_field(tel_raw)
-
-                df.at[idx, "jn_tel"] = tel_no_hyphen
-                df.at[idx, "jn_tel_hyphen"] = tel_hyphen
-                df.at[idx, "jn_company_name"] = best_match.get("company_name", "")
-                df.at[idx, "jn_location"] = best_match.get("location", "")
-                df.at[idx, "jn_detail_url"] = base_url + "/" + best_match.get("detail_url", "")
-                df.at[idx, "jn_memo"] = "住所検索で電話番号を埋めた。"
-            else:
-                logger.warning(f"[{idx}] 最適な一致が見つからなかった。")
-                df.at[idx, "jn_memo"] = "住所検索したけど見つからなかったわ。検索 URL つけたからそれ見てみて。"
-
-        except Exception as e:
-            df.at[idx, "jn_memo"] = f"なんかエラー起きたわ: {str(e)}"
-            logger.error(f"[{idx}] 処理中にエラー: {e}")
-        finally:
-            # 毎回保存する
-            df.to_csv(output_csv, index=False, encoding="utf_8_sig")
-
-            logger.info(f"[{idx}] 処理完了 CSV 保存も OK: {test_name}")
+            pending.append(record)
+
+        if args.task_db:
+            store = stack.enter_context(open_task_store_from_args(args))
+            results = jn.iter_search_tasks(store, pending, args, process_record)
+        else:
+            # --workers 2 以上なら、行をプロセスに振り分けて並列に検索する。結果は終わった順に来る。
+            results = jn.iter_search_results(pending, args, process_record)
+
+        with closing(results):
+            for record, values in results:
+                journal.record(record.idx, values)
+                # 毎回ジャーナルに保存してる
+                logger.info(f"[{record.idx}] 処理完了 ジャーナル保存も OK: {record.name}")
 
     logger.info("end mkmk_help_3")
 
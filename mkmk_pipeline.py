@@ -0,0 +1,329 @@
+"""
+LEVEL1 (jb の一覧と詳細) → LEVEL2 (jn 名前検索) → LEVEL3 (jn 住所検索) を、 CSV を挟まずに1本でやる。
+1社できるたびに次の段へ流すので、最初の結果はすぐ出るし、全体の時間はいちばん遅い段でほぼ決まる。
+住所検索は、名前検索で電話番号が見つからなかった会社だけ。
+
+pipenv run python mkmk_pipeline.py --base-url https://WWW.JAV.OR.JP --total-row 100 \
+    --jn-base-url https://WWW.JN.COM --output-csv mkmk_pipeline.csv
+
+NOTE: 結果は終わった順に CSV に書く。一覧の順番にしたいときは sort_csv_by_reference.py で並べ替える。
+"""
+
+import argparse
+import logging
+import queue
+import threading
+from collections.abc import Callable
+from typing import Any
+
+import jn
+import mkmk_help_2
+import mkmk_help_3
+from jb import DETAIL_PATH_TEMPLATE, NextDataRouteFetcher
+from jb import RESOURCE_POLICY as JB_RESOURCE_POLICY
+from mkmk_help import fetch_organization_detail, iter_listing_organizations
+from output_writers import CsvStreamWriter
+from row_processor import RowRecord
+from shared import (
+    ChromeDriverPool,
+    CloudflareClearance,
+    HostRateLimiter,
+    TokenBucket,
+    add_adaptive_rate_arguments,
+    add_cache_arguments,
+    add_html_parser_argument,
+    add_resource_policy_argument,
+    aimd_policy_from_args,
+    configure_html_parser_from_args,
+    configure_http_session,
+    configure_response_cache_from_args,
+    fetch_html_slowly,
+    resource_policy_from_args,
+    set_rate_limiter,
+    show_progress_with_name,
+)
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# 出力 CSV の列。 (mkmk_help_3.py の出力と同じ)
+PIPELINE_COLUMNS = [
+    "name",
+    "location",
+    "url",
+    "name_no_space",
+    "location_no_space",
+    "jn_search_url",
+    "jn_tel",
+    "jn_tel_hyphen",
+    "jn_company_name",
+    "jn_location",
+    "jn_detail_url",
+    "jn_memo",
+]
+
+# 上流が全部終わったことを下流に知らせる印。
+_DONE = object()
+
+# キューに流すもの: (一覧での通し番号, 1行ぶんの {列: 値})
+Item = tuple[int, dict[str, str]]
+
+
+class Stage:
+    """
+    inbox から1個ずつ取り出して func にかけ、 route(結果) が返すキューに入れるワーカースレッドたち。
+    - rps を指定すると、この段の処理を1秒に rps 回までにする。 (shared のホストごとのレート制限とは別に、さらに絞る)
+    - inbox に _DONE が来たら、全部のワーカーが終わったところで downstreams 全部に _DONE を流す。
+    - func が例外を出したら、その1個はログに出して捨てる。 (ほかの会社は止めない)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[Item], Item],
+        inbox: "queue.Queue[Any]",
+        route: Callable[[Item], "queue.Queue[Any]"],
+        downstreams: list["queue.Queue[Any]"],
+        workers: int = 1,
+        rps: float | None = None,
+    ) -> None:
+        if workers < 1:
+            raise ValueError(f"{name}: workers は 1 以上にしてね: {workers}")
+        self.name = name
+        self.func = func
+        self.inbox = inbox
+        self.route = route
+        self.downstreams = downstreams
+        self.workers = workers
+        self._bucket = TokenBucket(rps) if rps else None
+        self._alive = workers
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            # NOTE: Ctrl+C でメインスレッドが抜けたら、ワーカーも一緒に終わってほしいので daemon にする。
+            threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True).start()
+
+    def _run(self) -> None:
+        try:
+            while True:
+                item = self.inbox.get()
+                if item is _DONE:
+                    # NOTE: 兄弟のワーカーにも知らせるために戻しておく。
+                    self.inbox.put(_DONE)
+                    return
+                if self._bucket is not None:
+                    self._bucket.acquire()
+                try:
+                    result = self.func(item)
+                except Exception as e:
+                    logger.error(f"[{item[0]}] {self.name} でエラー、この会社は捨てる: {e}")
+                    continue
+                self.route(result).put(result)
+        finally:
+            with self._lock:
+                self._alive -= 1
+                last = self._alive == 0
+            if last:
+                for downstream in self.downstreams:
+                    downstream.put(_DONE)
+
+
+def produce_listing(organizations, outbox: "queue.Queue[Any]") -> None:
+    """
+    一覧の会社を1社ずつ outbox に流して、最後に _DONE を流す。 (一覧が途中で落ちても _DONE は流す)
+    """
+    try:
+        for seq, org in enumerate(organizations):
+            outbox.put((seq, org))
+    except Exception as e:
+        logger.error(f"一覧の取得でエラー、ここまでで打ち切り: {e}")
+    finally:
+        outbox.put(_DONE)
+
+
+def main() -> None:
+    logger.info("start mkmk_pipeline")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", required=True, help="Base url of jb")
+    parser.add_argument("--total-row", type=int, default=1, help="Number of organizations to fetch")
+    parser.add_argument("--jn-base-url", required=True, help="Base URL for jn search")
+    parser.add_argument("--output-csv", default="mkmk_pipeline.csv", help="Output CSV file path (UTF-8 with BOM)")
+    parser.add_argument("--rps", type=float, default=2.0, help="Max requests per second per host (all stages)")
+    parser.add_argument(
+        "--page-size", type=int, default=None, help="Rows per listing page (default: all rows on one page)"
+    )
+    parser.add_argument(
+        "--browser-pool-size", type=int, default=1, help="Number of headless Chrome fetching listing pages"
+    )
+    parser.add_argument(
+        "--listing-source",
+        choices=("html", "api"),
+        default="html",
+        help="Read the listing from the rendered table (html) or from the JSON the page fetches (api)",
+    )
+    parser.add_argument(
+        "--detail-path-template",
+        default=DETAIL_PATH_TEMPLATE,
+        help="Detail page path built from an organization id in --listing-source api mode",
+    )
+    parser.add_argument(
+        "--detail-source",
+        choices=("html", "next-data"),
+        default="html",
+        help="Fetch detail pages as HTML or as Next.js /_next/data/<buildId>/... JSON",
+    )
+    parser.add_argument("--detail-workers", type=int, default=1, help="Threads fetching jb detail pages")
+    parser.add_argument("--detail-rps", type=float, default=None, help="Max detail pages per second")
+    parser.add_argument("--name-search-workers", type=int, default=1, help="Headless Chrome for the jn name search")
+    parser.add_argument("--name-search-rps", type=float, default=None, help="Max jn name searches per second")
+    parser.add_argument(
+        "--address-search-workers", type=int, default=1, help="Headless Chrome for the jn address search"
+    )
+    parser.add_argument("--address-search-rps", type=float, default=None, help="Max jn address searches per second")
+    parser.add_argument("--queue-size", type=int, default=100, help="Max organizations waiting between two stages")
+    parser.add_argument("--wait-sec", type=int, default=10, help="Max seconds to wait for jn search results")
+    parser.add_argument(
+        "--recycle-after", type=int, default=50, help="Restart the headless Chrome after this many pages"
+    )
+    parser.add_argument(
+        "--cf-handoff",
+        action="store_true",
+        help="Solve the Cloudflare challenge once in Chrome, then fetch jn pages over plain HTTP with its cookies",
+    )
+    add_adaptive_rate_arguments(parser)
+    add_cache_arguments(parser)
+    add_html_parser_argument(parser)
+    add_resource_policy_argument(parser)
+    args = parser.parse_args()
+    configure_response_cache_from_args(args)
+    configure_html_parser_from_args(args)
+    base_url = args.base_url
+    jn_base_url = args.jn_base_url
+
+    # NOTE: 連続アクセスの間隔はレートリミッタだけで守る。
+    # --max-rps を指定すると、ホストごとのレートを拒否されるまで自動で上げていく。
+    set_rate_limiter(HostRateLimiter(rps=args.rps, aimd=aimd_policy_from_args(args)))
+    configure_http_session(pool_size=max(10, args.detail_workers))
+
+    # 段と段のあいだのキュー。 いっぱいになったら上流は待つので、メモリは一定。
+    listing_q: queue.Queue[Any] = queue.Queue(maxsize=args.queue_size)
+    name_q: queue.Queue[Any] = queue.Queue(maxsize=args.queue_size)
+    address_q: queue.Queue[Any] = queue.Queue(maxsize=args.queue_size)
+    out_q: queue.Queue[Any] = queue.Queue(maxsize=args.queue_size)
+
+    jn_search_workers = args.name_search_workers + args.address_search_workers
+    with (
+        ChromeDriverPool(
+            size=args.browser_pool_size,
+            capture_network=args.listing_source == "api",
+            resource_policy=resource_policy_from_args(args, JB_RESOURCE_POLICY),
+        ) as listing_pool,
+        ChromeDriverPool(
+            size=jn_search_workers,
+            max_pages_per_driver=args.recycle_after,
+            resource_policy=resource_policy_from_args(args, jn.RESOURCE_POLICY),
+        ) as jn_pool,
+        CsvStreamWriter(args.output_csv, PIPELINE_COLUMNS, encoding="utf_8_sig") as writer,
+    ):
+        # --cf-handoff のときは、 Cloudflare を突破した cookie で素の HTTP を使う。
+        clearance = CloudflareClearance(jn_pool) if args.cf_handoff else None
+        next_data_fetcher = NextDataRouteFetcher(base_url) if args.detail_source == "next-data" else None
+
+        def fetch_search_page(search_url: str) -> str:
+            # HTML を取得します。 検索結果が出たらすぐ次へ (最大 wait_sec 秒待つ)。
+            if clearance is not None:
+                return clearance.fetch(search_url, wait_sec=args.wait_sec, ready=jn.SEARCH_READY_CONDITION)
+            return fetch_html_slowly(search_url, wait_sec=args.wait_sec, pool=jn_pool, ready=jn.SEARCH_READY_CONDITION)
+
+        def fetch_detail(item: Item) -> Item:
+            seq, org = item
+            row = dict.fromkeys(PIPELINE_COLUMNS, "")
+            try:
+                row.update(fetch_organization_detail(org, next_data_fetcher=next_data_fetcher))
+            except Exception as e:
+                logger.error(f"[{seq}] 詳細の取得でエラー: {e}")
+                row.update(name=org["name"], url=org["url"], jn_memo=f"詳細の取得でエラー起きたわ: {e}")
+            return seq, row
+
+        def search_by_name(item: Item) -> Item:
+            # LEVEL2: 名前で検索して、住所でバリデーションする。
+            seq, row = item
+            row["name_no_space"] = jn.remove_spaces(row["name"])
+            row["jn_search_url"] = jn.create_search_url(jn_base_url, row["name_no_space"])
+            record = RowRecord(idx=seq, name=row["name"], location=row["location"], search_url=row["jn_search_url"])
+            row.update(mkmk_help_2.process_record(record, fetch_search_page, jn_base_url))
+            return seq, row
+
+        def search_by_address(item: Item) -> Item:
+            # LEVEL3: 住所で検索して、名前でバリデーションする。
+            seq, row = item
+            row["location_no_space"] = jn.remove_spaces(row["location"])
+            row["jn_search_url"] = jn.create_search_url(jn_base_url, row["location_no_space"])
+            record = RowRecord(idx=seq, name=row["name"], location=row["location"], search_url=row["jn_search_url"])
+            row.update(mkmk_help_3.process_record(record, fetch_search_page, jn_base_url))
+            return seq, row
+
+        stages = [
+            # 詳細が取れなかった会社は、検索しないでそのまま書き出す。
+            Stage(
+                "詳細",
+                fetch_detail,
+                listing_q,
+                route=lambda item: out_q if item[1]["jn_memo"] else name_q,
+                downstreams=[name_q, out_q],
+                workers=args.detail_workers,
+                rps=args.detail_rps,
+            ),
+            # 電話番号が見つかった会社はそのまま書き出す。見つからなかった会社だけ住所検索へ。
+            Stage(
+                "名前検索",
+                search_by_name,
+                name_q,
+                route=lambda item: out_q if item[1]["jn_tel"] else address_q,
+                downstreams=[address_q, out_q],
+                workers=args.name_search_workers,
+                rps=args.name_search_rps,
+            ),
+            Stage(
+                "住所検索",
+                search_by_address,
+                address_q,
+                route=lambda item: out_q,
+                downstreams=[out_q],
+                workers=args.address_search_workers,
+                rps=args.address_search_rps,
+            ),
+        ]
+        for stage in stages:
+            stage.start()
+
+        # 一覧のページが届いたそばから、1社ずつ流す。
+        page_size = args.page_size or args.total_row
+        organizations = iter_listing_organizations(
+            base_url, args.total_row, page_size, listing_pool, args.listing_source, args.detail_path_template
+        )
+        threading.Thread(target=produce_listing, args=(organizations, listing_q), name="一覧", daemon=True).start()
+
+        # out_q に流してくる段がぜんぶ _DONE を流してきたら終わり。
+        remaining_upstreams = sum(out_q in stage.downstreams for stage in stages)
+        written = 0
+        while remaining_upstreams:
+            item = out_q.get()
+            if item is _DONE:
+                remaining_upstreams -= 1
+                continue
+            _, row = item
+            writer.write(row)
+            written += 1
+            show_progress_with_name(written, args.total_row, row["name"])
+
+        # NOTE: 改行のため
+        print()
+
+    logger.info(f"end mkmk_pipeline ({written} 社)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import heapq
+from collections import Counter, defaultdict
+from collections.abc import Iterable
+from typing import NamedTuple
+
+from name_similarity import normalize_name_for_matching
+
+# 類似度の計算方法。
+# jaccard: 共通の n-gram の数 / どちらかにある n-gram の数
+# containment: 共通の n-gram の数 / 短いほうの n-gram の数 (短い名前がまるごと含まれていれば 1.0)
+NGRAM_METRICS = ("jaccard", "containment")
+
+
+class NameMatch(NamedTuple):
+    """
+    NameNgramIndex で引いた結果1件。
+    """
+
+    candidate: dict
+    score: float
+
+
+def make_ngrams(normalized_name: str, n: int = 2) -> frozenset[str]:
+    """
+    正規化済みの名前の文字 n-gram 。 n 文字より短い名前は、名前そのものを1個の n-gram にする。
+    """
+    if len(normalized_name) <= n:
+        return frozenset((normalized_name,)) if normalized_name else frozenset()
+    return frozenset(normalized_name[i : i + n] for i in range(len(normalized_name) - n + 1))
+
+
+class NameNgramIndex:
+    """
+    会社名をあいまいに引くための、文字 n-gram の転置インデックス。
+    name_similarity.calculate_name_similarity は完全一致と部分一致しか見ないし、候補を全部なめるので、
+    候補が数千件あると遅いし、表記ゆれ (一部の文字違い) も拾えない。
+    ここでは候補の名前を正規化 (normalize_name_for_matching) して n-gram に分け、
+    n-gram -> 候補 の表を作っておく。引くときは、共通の n-gram を持つ候補だけを数えて類似度を出す。
+    NOTE: 部分一致する名前 (n 文字以上) は containment が 1.0 になるので、
+    calculate_name_similarity で拾えるものは全部拾える。
+    """
+
+    def __init__(
+        self, candidates: Iterable[dict] = (), name_key: str = "company_name", n: int = 2, metric: str = "jaccard"
+    ) -> None:
+        if metric not in NGRAM_METRICS:
+            raise ValueError(f"metric は {NGRAM_METRICS} のどれか: {metric}")
+        self.name_key = name_key
+        self.n = n
+        self.metric = metric
+        self._candidates: list[dict] = []
+        self._ngram_counts: list[int] = []
+        self._postings: dict[str, list[int]] = defaultdict(list)
+        for candidate in candidates:
+            self.add(candidate)
+
+    def __len__(self) -> int:
+        return len(self._candidates)
+
+    def add(self, candidate: dict) -> None:
+        """
+        候補を1件追加します。名前が空の候補は、どの名前とも一致しない。
+        """
+        i = len(self._candidates)
+        self._candidates.append(candidate)
+        ngrams = make_ngrams(normalize_name_for_matching(candidate.get(self.name_key) or ""), self.n)
+        self._ngram_counts.append(len(ngrams))
+        for ngram in ngrams:
+            self._postings[ngram].append(i)
+
+    def top_k(self, name: str, k: int = 5, min_score: float = 0.0) -> list[NameMatch]:
+        """
+        name に似ている候補を、類似度の高い順に最大 k 件返します。 min_score 未満は返さない。
+        同点なら、候補を入れた順番で先のもの。
+        """
+        ngrams = make_ngrams(normalize_name_for_matching(name or ""), self.n)
+        if not ngrams:
+            return []
+
+        # {候補の番号: 共通の n-gram の数}
+        # NOTE: Counter.update は C で数えるので、候補ごとに += するより速い。
+        shared_counts: Counter[int] = Counter()
+        for ngram in ngrams:
+            shared_counts.update(self._postings.get(ngram, ()))
+
+        scored = ((self._score(shared, len(ngrams), self._ngram_counts[i]), i) for i, shared in shared_counts.items())
+        best = heapq.nsmallest(k, ((-score, i) for score, i in scored if score >= min_score))
+        return [NameMatch(self._candidates[i], -negative_score) for negative_score, i in best]
+
+    def match(self, name: str, threshold: float = 0.7) -> NameMatch | None:
+        """
+        name にいちばん似ている候補。 threshold 未満なら None 。
+        """
+        matches = self.top_k(name, k=1, min_score=threshold)
+        return matches[0] if matches else None
+
+    def top_k_all(self, names: Iterable[str], k: int = 5, min_score: float = 0.0) -> list[list[NameMatch]]:
+        """
+        名前の列をまとめて引きます。結果は names と同じ順番。
+        同じ名前が何回も出てきたら、2回目以降は1回目の結果を使い回す。
+        """
+        results: dict[str, list[NameMatch]] = {}
+        return [
+            results[name] if name in results else results.setdefault(name, self.top_k(name, k, min_score))
+            for name in names
+        ]
+
+    def match_all(self, names: Iterable[str], threshold: float = 0.7) -> list[NameMatch | None]:
+        """
+        名前の列をまとめて、それぞれいちばん似ている候補を返します。 threshold 未満なら None 。
+        """
+        return [matches[0] if matches else None for matches in self.top_k_all(names, k=1, min_score=threshold)]
+
+    def _score(self, shared: int, query_count: int, candidate_count: int) -> float:
+        if self.metric == "containment":
+            return shared / min(query_count, candidate_count)
+        return shared / (query_count + candidate_count - shared)
+
+
+# 動作確認用
+# pipenv run python name_index.py
+if __name__ == "__main__":
+    index = NameNgramIndex(
+        [
+            {"company_name": "FOO株式会社"},
+            {"company_name": "QUXロジテック 株式会社"},
+            {"company_name": "QUXロジスティクス 有限会社"},
+            {"company_name": "Baz Next Stage"},
+        ]
+    )
+    for name in ["QUXロジテック", "ＢＡＺ ＮＥＸＴ ＳＴＡＧＥ", "全然違う会社"]:
+        for candidate, score in index.top_k(name, k=3):
+            print(f"'{name}' -> '{candidate['company_name']}': {score:.2f}")
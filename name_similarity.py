@@ -1,14 +1,35 @@
 import logging
 import re
+from functools import lru_cache
+
+import pandas as pd
+
+from shared import map_unique_values
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
 
+# 法人格。
+_CORPORATE_TYPE_RE = re.compile(r"(株式|有限|合同)会社")
+
+# 全角英数字 -> 半角。
+_ZENKAKU_TABLE = str.maketrans(
+    "０１２３４５６７８９ＡＢＣＤＥＦＧＨＩＪＫＬＭＮＯＰＱＲＳＴＵＶＷＸＹＺａｂｃｄｅｆｇｈｉｊｋｌｍｎｏｐｑｒｓｔｕｖｗｘｙｚ",
+    "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz",
+)
+
+# 記号。
+_SYMBOLS_RE = re.compile(r"[‐\ーｰ・,、。!！?？（）()［］【】｛｝「」『』]")
+
+# normalize_name_for_matching が覚えておく名前の数。
+NORMALIZE_CACHE_SIZE = 8192
 
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
 def normalize_name_for_matching(name: str) -> str:
     """
     名前マッチング用の正規化
     法人格除去 + 記号除去 + スペース除去 + 小文字統一
+    NOTE: 同じ名前を何回も正規化するので、結果を覚えておく。
     """
     if not name:
         return ""
@@ -25,6 +46,13 @@ def normalize_name_for_matching(name: str) -> str:
     return normalized
 
 
+def normalize_name_for_matching_series(names: pd.Series) -> pd.Series:
+    """
+    normalize_name_for_matching の Series 版。 NaN は NaN のまま。
+    """
+    return map_unique_values(names, normalize_name_for_matching)
+
+
 def remove_spaces(name: str) -> str:
     """
     文字列をノーマライズする。
@@ -38,7 +66,7 @@ def remove_corporate_type(name: str) -> str:
     文字列をノーマライズする。
     法人格除去だけ (スペースは残す)
     """
-    return re.sub(r"(株式|有限|合同)会社", "", name)
+    return _CORPORATE_TYPE_RE.sub("", name)
 
 
 def normalize_symbols_and_zenkaku(name: str) -> str:
@@ -46,13 +74,8 @@ def normalize_symbols_and_zenkaku(name: str) -> str:
     文字列をノーマライズする。
     全角英数字→半角 + 記号除去だけ (スペース除去なし)
     """
-    name = name.translate(
-        str.maketrans(
-            "０１２３４５６７８９ＡＢＣＤＥＦＧＨＩＪＫＬＭＮＯＰＱＲＳＴＵＶＷＸＹＺａｂｃｄｅｆｇｈｉｊｋｌｍｎｏｐｑｒｓｔｕｖｗｘｙｚ",
-            "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz",
-        )
-    )
-    return re.sub(r"[‐\ーｰ・,、。!！?？（）()［］【】｛｝「」『』]", "", name)
+    name = name.translate(_ZENKAKU_TABLE)
+    return _SYMBOLS_RE.sub("", name)
 
 
 def calculate_name_similarity(name1: str, name2: str, threshold: float = 0.7) -> float:
@@ -67,6 +90,13 @@ def calculate_name_similarity(name1: str, name2: str, threshold: float = 0.7) ->
     name1_normalized = normalize_name_for_matching(name1)
     name2_normalized = normalize_name_for_matching(name2)
 
+    return _calculate_normalized_name_similarity(name1_normalized, name2_normalized)
+
+
+def _calculate_normalized_name_similarity(name1_normalized: str, name2_normalized: str) -> float:
+    """
+    正規化済みの名前どうしの類似度 (0.0-1.0)
+    """
     # マッチング戦略:
     # 1. 完全一致
     if name1_normalized == name2_normalized:
@@ -90,6 +120,14 @@ def find_best_match_by_name(search_results: list[dict], target_name: str, thresh
     if not search_results:
         return None
 
+    if not target_name:
+        return None
+
+    # NOTE: target_name の正規化はループの外で1回だけ。
+    target_normalized = normalize_name_for_matching(target_name)
+    # NOTE: DEBUG が出ないときは、比較ごとのログ文字列を作らない。
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+
     best_match = None
     best_score = 0.0
 
@@ -99,8 +137,9 @@ def find_best_match_by_name(search_results: list[dict], target_name: str, thresh
             continue
 
         # 類似度を計算
-        score = calculate_name_similarity(target_name, company_name)
-        logger.debug(f"名前マッチング: '{target_name}' vs '{company_name}' = {score:.2f}")
+        score = _calculate_normalized_name_similarity(target_normalized, normalize_name_for_matching(company_name))
+        if debug_enabled:
+            logger.debug(f"名前マッチング: '{target_name}' vs '{company_name}' = {score:.2f}")
 
         if score > best_score:
             best_score = score
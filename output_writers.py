@@ -0,0 +1,215 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+import time
+
+import pandas as pd
+
+from row_processor import ResultBuffer
+
+logger = logging.getLogger(__name__)
+
+
+class RowJournal:
+    """
+    1行ぶんの処理結果を、ジャーナルファイル (JSON Lines) に追記していくやつ。
+    毎行 CSV 全体を書き直すと O(n²) になるので、変わった行だけ追記して、最後に1回だけ CSV にまとめる。
+
+    - record するたびに flush する。 fsync は fsync_every 行ごとにまとめてやる。
+    - df への反映は apply_every 行ごとに、ためた行ぶんを列ごとにまとめてやる (ResultBuffer)。
+    - with を抜けるとき (Ctrl+C の KeyboardInterrupt でも) に、 df に反映して output_csv に書き出す。
+      最後まで終わったときだけジャーナルを消す。 (Ctrl+C や例外で抜けたときは、次回の再開用に残す)
+    - 前回の実行が途中で落ちてジャーナルが残っていたら、開いたときに df に反映する。
+      ただし、ジャーナルの先頭に書いた fingerprint (input_fingerprint: スクリプト、入力 CSV、行数、 url 列) が
+      今回と同じときだけ。違ったら (例: Level 2 のジャーナルを Level 3 で開いた) 反映せずに、脇によけて新しく始める。
+    - idx in journal で、その行がもうジャーナルにある (前回か今回で処理済み) かがわかる。
+    """
+
+    def __init__(
+        self, df: pd.DataFrame, output_csv: str, fingerprint: str, fsync_every: int = 20, apply_every: int = 1000
+    ) -> None:
+        self.df = df
+        self.output_csv = output_csv
+        self.fingerprint = fingerprint
+        self.journal_path = f"{output_csv}.journal.jsonl"
+        self.fsync_every = fsync_every
+        self.apply_every = apply_every
+        self._buffer = ResultBuffer()
+        self._recorded: set[int] = set()
+        self._unsynced = 0
+        self._torn_tail = False
+
+        replayed = self._replay()
+        if replayed:
+            logger.info(f"前回のジャーナルから {replayed} 行を復元: {self.journal_path}")
+        is_new = not os.path.exists(self.journal_path) or os.path.getsize(self.journal_path) == 0
+        self._file = open(self.journal_path, "a", encoding="utf-8")
+        if is_new:
+            self._file.write(json.dumps({"fingerprint": fingerprint}, ensure_ascii=False) + "\n")
+            self._file.flush()
+        elif self._torn_tail:
+            # NOTE: 書きかけの最終行に続けて書くと、次の行まで壊れちゃうので改行しておく。
+            self._file.write("\n")
+
+    def __enter__(self) -> "RowJournal":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.compact(keep_journal=exc_type is not None)
+
+    def __contains__(self, idx: int) -> bool:
+        return int(idx) in self._recorded
+
+    def record(self, idx: int, values: dict[str, str]) -> None:
+        """
+        idx 行目の列の値をジャーナルに追記します。
+        """
+        idx = int(idx)
+        self._file.write(json.dumps({"idx": idx, "values": values}, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self._buffer.add(idx, values)
+        self._recorded.add(idx)
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self._sync()
+        # NOTE: df.loc は1回ごとのコストが大きいので、数行ずつではなく、ある程度ためてから反映する。
+        if len(self._buffer) >= self.apply_every:
+            self._buffer.apply_to(self.df)
+
+    def compact(self, keep_journal: bool = False) -> None:
+        """
+        ジャーナルの中身を df に反映して、 output_csv (UTF-8 with BOM) に書き出します。
+        書き出しが終わったらジャーナルは消す。 keep_journal=True なら、次回の再開用に残す。
+        """
+        if self._file.closed:
+            return
+        self._sync()
+        self._file.close()
+        self._buffer.apply_to(self.df)
+
+        # NOTE: 書いてる途中で落ちても、前の CSV とジャーナルが残るように一時ファイル経由で置き換える。
+        tmp_path = f"{self.output_csv}.tmp"
+        self.df.to_csv(tmp_path, index=False, encoding="utf_8_sig")
+        os.replace(tmp_path, self.output_csv)
+        if keep_journal:
+            logger.info(f"ジャーナルを CSV にまとめたよ (再開用にジャーナルは残す): {self.output_csv}")
+            return
+        os.remove(self.journal_path)
+        logger.info(f"ジャーナルを CSV にまとめたよ: {self.output_csv}")
+
+    def _sync(self) -> None:
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def _replay(self) -> int:
+        if not os.path.exists(self.journal_path):
+            return 0
+        with open(self.journal_path, encoding="utf-8") as f:
+            header = f.readline()
+            if not header.strip():
+                return 0
+            if _read_fingerprint(header) != self.fingerprint:
+                stale_path = f"{self.journal_path}.{time.strftime('%Y%m%d%H%M%S')}.stale"
+                f.close()
+                os.replace(self.journal_path, stale_path)
+                logger.warning(f"ジャーナルが今回と違う入力で書かれたものなので、反映せずによけた: {stale_path}")
+                return 0
+            self._torn_tail = not header.endswith("\n")
+            for line in f:
+                self._torn_tail = not line.endswith("\n")
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # NOTE: 落ちたときの書きかけの最終行。
+                    logger.warning("ジャーナルの壊れた行を無視")
+                    continue
+                if entry["idx"] in self.df.index:
+                    self._buffer.add(entry["idx"], entry["values"])
+                    self._recorded.add(entry["idx"])
+        replayed = len(self._buffer)
+        self._buffer.apply_to(self.df)
+        return replayed
+
+
+def _read_fingerprint(header: str) -> str | None:
+    """
+    ジャーナルの1行目から fingerprint を読む。 (fingerprint を書いていなかった古いジャーナルなら None)
+    """
+    try:
+        entry = json.loads(header)
+    except json.JSONDecodeError:
+        return None
+    return entry.get("fingerprint") if isinstance(entry, dict) else None
+
+
+def input_fingerprint(script: str, csv_path: str, urls: pd.Series) -> str:
+    """
+    RowJournal の fingerprint 。どのスクリプトが、どの入力 CSV (パス、行数、 url 列の中身) を処理したか。
+    NOTE: ジャーナルは行番号で df に戻すので、入力が違うのに戻すと、関係ない行に別の会社の結果が入ってしまう。
+    """
+    digest = hashlib.sha256("\n".join(urls.fillna("").astype(str)).encode("utf-8")).hexdigest()
+    return f"{script}|{os.path.abspath(csv_path)}|{len(urls)}|{digest}"
+
+
+class CsvStreamWriter:
+    """
+    1行できるたびに CSV に追記していくやつ。全部をメモリに溜めないので、行数が増えてもメモリは一定。
+    append=True なら既存のファイルの後ろに足す (ヘッダーは、ファイルが空のときだけ書く)。
+    """
+
+    def __init__(self, filename: str, fieldnames: list[str], append: bool = False, encoding: str = "utf-8") -> None:
+        self.filename = filename
+        is_empty = not append or not os.path.exists(filename) or os.path.getsize(filename) == 0
+        if not is_empty:
+            _drop_torn_tail(filename)
+        self._file = open(filename, "a" if append else "w", encoding=encoding, newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=fieldnames)
+        if is_empty:
+            self._writer.writeheader()
+            self._file.flush()
+
+    def __enter__(self) -> "CsvStreamWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def write(self, row: dict[str, str]) -> None:
+        self._writer.writerow(row)
+        self._file.flush()
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+            logger.info(f"{self.filename} おｋ")
+
+
+def read_written_urls(csv_path: str) -> set[str]:
+    """
+    CsvStreamWriter で書いた CSV の url 列を読みます。 --resume で、もう書いた組織を飛ばすのに使う。
+    NOTE: 書いた CSV そのものを「済み」の記録にする。別のファイル (チェックポイント) に書くと、
+    CSV に書いてから記録するまでの間に落ちたとき、再開でその行が二重に書かれる。
+    """
+    if not os.path.exists(csv_path):
+        return set()
+    # NOTE: BOM つきでもなしでも読めるように utf-8-sig 。
+    with open(csv_path, encoding="utf-8-sig", newline="") as f:
+        return {row["url"] for row in csv.DictReader(f) if row.get("url")}
+
+
+def _drop_torn_tail(filename: str) -> None:
+    """
+    落ちたときの書きかけの最終行 (改行で終わっていない行) を切り捨てます。
+    NOTE: 残したまま追記すると、次の行がくっついて壊れる。 (url も途中までなので、その組織は取り直しになる)
+    """
+    with open(filename, "rb+") as f:
+        data = f.read()
+        if data.endswith(b"\n"):
+            return
+        f.truncate(data.rfind(b"\n") + 1)
+    logger.warning(f"書きかけの最終行を捨てた: {filename}")
@@ -0,0 +1,97 @@
+from collections.abc import Iterator
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+# ResultBuffer で「この列はこの行では変えない」を表す印。
+_MISSING = object()
+
+
+@dataclass(slots=True)
+class RowRecord:
+    """
+    mkmk_help_2 / mkmk_help_3 が1行ぶんの処理で使う値だけを持つ、軽い入れ物。
+    NOTE: df.iterrows() は行ごとに Series を作るので遅い。こっちは itertuples から作る。
+    """
+
+    idx: int
+    name: str
+    location: str
+    search_url: str
+    jn_tel: str = ""
+
+
+# RowRecord のフィールド -> df の列。
+ROW_RECORD_COLUMNS = {
+    "name": "name",
+    "location": "location",
+    "search_url": "jn_search_url",
+    "jn_tel": "jn_tel",
+}
+
+
+def _text(value) -> str:
+    """
+    CSV から読んだセルの値を文字列にする。 NaN (空のセル) は空文字列。
+    """
+    if isinstance(value, str):
+        return value
+    return "" if pd.isna(value) else str(value)
+
+
+def iter_row_records(df: pd.DataFrame) -> Iterator[RowRecord]:
+    """
+    df の各行を RowRecord にして、 df の順番で返します。 df に無い列のフィールドは空文字列。
+    """
+    fields = [field for field, column in ROW_RECORD_COLUMNS.items() if column in df.columns]
+    columns = [ROW_RECORD_COLUMNS[field] for field in fields]
+    for idx, *values in df[columns].itertuples(index=True, name=None):
+        yield RowRecord(idx=idx, **{field: _text(value) for field, value in zip(fields, values)})
+
+
+class ResultBuffer:
+    """
+    行ごとの処理結果 ({列: 値}) を、列ごとの配列にためておくやつ。
+    apply_to(df) で、列ごとに1回の df.loc でまとめて df に書き込む。 (セルごとに df.at するより速い)
+    同じ行が2回 add されたら、あとの値で上書きする。 (その行で渡されなかった列は、前の値のまま)
+    """
+
+    def __init__(self) -> None:
+        self._index: list[int] = []
+        self._positions: dict[int, int] = {}
+        self._columns: dict[str, list] = {}
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def add(self, idx: int, values: dict[str, str]) -> None:
+        position = self._positions.get(idx)
+        if position is None:
+            position = self._positions[idx] = len(self._index)
+            self._index.append(idx)
+            for array in self._columns.values():
+                array.append(_MISSING)
+        for column, value in values.items():
+            array = self._columns.get(column)
+            if array is None:
+                array = self._columns[column] = [_MISSING] * len(self._index)
+            array[position] = value
+
+    def apply_to(self, df: pd.DataFrame) -> None:
+        """
+        ためている結果を df に書き込んで、空にします。
+        """
+        if not self._index:
+            return
+        index = np.array(self._index)
+        for column, array in self._columns.items():
+            values = np.array(array, dtype=object)
+            present = np.fromiter((value is not _MISSING for value in array), dtype=bool, count=len(array))
+            df.loc[index[present], column] = values[present]
+        self.clear()
+
+    def clear(self) -> None:
+        self._index = []
+        self._positions = {}
+        self._columns = {}
@@ -1,23 +1,720 @@
+import argparse
+import base64
+import importlib.util
+import json
 import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import random
+import signal
 import sys
+import threading
 import time
+import zlib
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import AbstractContextManager, contextmanager
+from dataclasses import dataclass
+from typing import Any, NamedTuple, TypeVar
+from urllib.parse import urlsplit
 
+import numpy as np
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from urllib3.util.request import ACCEPT_ENCODING
+
+from http_cache import CacheMissError, ResponseCache
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
 
-def fetch_html_slowly(url: str, wait_sec: int = 3) -> str:
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class TokenBucket:
     """
-    指定された URL にアクセスし、JavaScript 実行後の HTML をのんびり取得します。
-    Cloudflare の bot 検出を回避するための設定を追加。
+    トークンバケット。1秒に rate 個トークンがたまり、 capacity 個まで貯金できる。
+    acquire はトークンが1個とれるまで待ちます。スレッドセーフ。
     """
 
+    def __init__(self, rate: float, capacity: float = 1) -> None:
+        if rate <= 0:
+            raise ValueError(f"rate は 0 より大きくしてね: {rate}")
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            # NOTE: 足りなくても先にトークンを借りる (マイナスにする) ことで、待ってる人たちの順番を確定させる。
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+    def set_rate(self, rate: float) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self.rate = rate
+
+
+@dataclass(frozen=True)
+class AimdPolicy:
+    """
+    レートを自動で調整するルール (AIMD: 足し算で上げて、掛け算で下げる)。
+    ふつうに取れている間は、1回ごとに rate に increase を足す (max_rps まで)。
+    401 / 429 / Cloudflare チャレンジを食らったら、 rate に decrease を掛ける (min_rps まで)。
+    NOTE: 同時に飛んでいたリクエストがまとめて拒否されたときに何回も下げないよう、下げたあと cooldown_sec 秒は下げない。
+    """
+
+    min_rps: float = 0.1
+    max_rps: float = 10
+    increase: float = 0.05
+    decrease: float = 0.5
+    cooldown_sec: float = 5
+
+    def __post_init__(self) -> None:
+        if not 0 < self.min_rps <= self.max_rps:
+            raise ValueError(f"0 < min_rps <= max_rps にしてね: {self.min_rps}, {self.max_rps}")
+        if not 0 < self.decrease < 1:
+            raise ValueError(f"decrease は 0 と 1 の間にしてね: {self.decrease}")
+
+    def next_rate(self, rate: float, throttled: bool) -> float:
+        if throttled:
+            return max(self.min_rps, rate * self.decrease)
+        return min(self.max_rps, rate + self.increase)
+
+
+def _log_rate_change(host: str, old_rate: float, new_rate: float, throttled: bool) -> None:
+    if throttled:
+        logger.warning(f"{host} に拒否されたのでレートを下げる: {old_rate:.2f} -> {new_rate:.2f} req/s")
+    elif int(new_rate * 2) != int(old_rate * 2):
+        # NOTE: 上げるほうは毎回だとうるさいので、 0.5 req/s の区切りをまたいだときだけ。
+        logger.info(f"{host} のレートを上げる: {new_rate:.2f} req/s")
+
+
+class HostRateLimiter:
+    """
+    ホストごとのトークンバケットでアクセス間隔を守るやつ。
+    サイトへの礼儀はこれだけが守る (呼び出し側で sleep しない)。
+    aimd を渡すと、ホストごとのレートを rps から始めて、 report された結果に合わせて上げ下げする。
+    """
+
+    def __init__(self, rps: float, burst: float = 1, aimd: AimdPolicy | None = None) -> None:
+        self.rps = rps
+        self.burst = burst
+        self.aimd = aimd
+        self._buckets: dict[str, TokenBucket] = {}
+        self._decreased_at: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, url: str) -> TokenBucket:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rps, self.burst)
+            return self._buckets[host]
+
+    def acquire(self, url: str) -> None:
+        self.bucket(url).acquire()
+
+    def rate(self, url: str) -> float:
+        return self.bucket(url).rate
+
+    def report(self, url: str, throttled: bool) -> None:
+        """
+        url へのアクセスの結果を伝えます。 throttled: 401 / 429 / Cloudflare チャレンジを食らったか。
+        aimd が無ければ何もしない。
+        """
+        if self.aimd is None:
+            return
+        host = urlsplit(url).netloc
+        bucket = self.bucket(url)
+        with self._lock:
+            now = time.monotonic()
+            if throttled:
+                if now - self._decreased_at.get(host, -self.aimd.cooldown_sec) < self.aimd.cooldown_sec:
+                    return
+                self._decreased_at[host] = now
+            old_rate = bucket.rate
+            new_rate = self.aimd.next_rate(old_rate, throttled)
+            if new_rate == old_rate:
+                return
+            bucket.set_rate(new_rate)
+        _log_rate_change(host, old_rate, new_rate, throttled)
+
+
+class SharedHostRateLimiter:
+    """
+    複数プロセス (--workers) で共有できる、ホストごとのレート制限。 HostRateLimiter と同じように使える。
+    各ホストの「次にアクセスしていい時刻」を共有メモリに置いて、ロックを取って順番に予約する。
+    ホストはハッシュで slots 個の枠のどれかに割り当てる。
+    枠がぶつかったホストどうしは間隔を共有する (遅くなるだけで、速くはならない)。
+    aimd を渡すと、レートも枠ごとに共有メモリに置いて、どのプロセスの report でも上げ下げする。
+    NOTE: multiprocessing の Lock と Array を持っているので、 Process の引数で子プロセスに渡すこと。
+    """
+
+    def __init__(self, rps: float, slots: int = 64, aimd: AimdPolicy | None = None) -> None:
+        if rps <= 0:
+            raise ValueError(f"rps は 0 より大きくしてね: {rps}")
+        self.rps = rps
+        self.aimd = aimd
+        self._next_allowed_at = multiprocessing.Array("d", slots, lock=False)
+        self._rates = multiprocessing.Array("d", [rps] * slots, lock=False)
+        self._decreased_at = multiprocessing.Array("d", slots, lock=False)
+        self._lock = multiprocessing.Lock()
+
+    def _slot(self, url: str) -> int:
+        return zlib.crc32(urlsplit(url).netloc.encode("utf-8")) % len(self._next_allowed_at)
+
+    def acquire(self, url: str) -> None:
+        slot = self._slot(url)
+        # NOTE: time.monotonic はプロセスをまたぐと比べられない (OS による) ので time.time を使う。
+        with self._lock:
+            now = time.time()
+            allowed_at = max(now, self._next_allowed_at[slot])
+            self._next_allowed_at[slot] = allowed_at + 1 / self._rates[slot]
+        if allowed_at > now:
+            time.sleep(allowed_at - now)
+
+    def rate(self, url: str) -> float:
+        return self._rates[self._slot(url)]
+
+    def report(self, url: str, throttled: bool) -> None:
+        """
+        HostRateLimiter.report と同じ。
+        """
+        if self.aimd is None:
+            return
+        slot = self._slot(url)
+        with self._lock:
+            now = time.time()
+            if throttled:
+                if now - self._decreased_at[slot] < self.aimd.cooldown_sec:
+                    return
+                self._decreased_at[slot] = now
+            old_rate = self._rates[slot]
+            new_rate = self.aimd.next_rate(old_rate, throttled)
+            if new_rate == old_rate:
+                return
+            self._rates[slot] = new_rate
+        _log_rate_change(urlsplit(url).netloc, old_rate, new_rate, throttled)
+
+
+_rate_limiter: HostRateLimiter | SharedHostRateLimiter | None = None
+
+
+def set_rate_limiter(limiter: HostRateLimiter | SharedHostRateLimiter | None) -> None:
+    """
+    fetch_html, fetch_html_with_retry, fetch_html_slowly が使うレートリミッタを設定します。
+    None ならレート制限なし。
+    """
+    global _rate_limiter
+    _rate_limiter = limiter
+    if limiter is None:
+        return
+    if limiter.aimd is None:
+        logger.info(f"レート制限おｋ (ホストごとに {limiter.rps} req/s)")
+    else:
+        logger.info(
+            f"レート制限おｋ (ホストごとに {limiter.rps} req/s から自動調整, "
+            f"{limiter.aimd.min_rps} - {limiter.aimd.max_rps} req/s)"
+        )
+
+
+def add_adaptive_rate_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    レートの自動調整用のコマンドライン引数を追加します。 aimd_policy_from_args とセットで使う。
+    NOTE: --rps はスクリプトごとに (help が違うので) 自分で追加すること。
+    """
+    parser.add_argument(
+        "--max-rps",
+        type=float,
+        default=None,
+        help="Adapt the per-host rate between --min-rps and this, starting at --rps "
+        "(faster while pages come back fine, halved on 401/429/Cloudflare challenges)",
+    )
+    parser.add_argument("--min-rps", type=float, default=0.1, help="Lowest per-host rate when --max-rps is set")
+
+
+def aimd_policy_from_args(args: argparse.Namespace) -> AimdPolicy | None:
+    """
+    --max-rps が無ければ None (レートは --rps で固定)。
+    """
+    if args.max_rps is None:
+        return None
+    if not args.min_rps <= args.rps <= args.max_rps:
+        raise ValueError(f"--min-rps <= --rps <= --max-rps にしてね: {args.min_rps}, {args.rps}, {args.max_rps}")
+    return AimdPolicy(min_rps=args.min_rps, max_rps=args.max_rps)
+
+
+def _wait_for_rate_limit(url: str) -> None:
+    if _rate_limiter is not None:
+        _rate_limiter.acquire(url)
+
+
+# これが返ってきたら「速すぎ」とみなす HTTP ステータス。
+THROTTLED_STATUS_CODES = (401, 429)
+
+
+def is_throttled_response(text: str, status_code: int | None = None) -> bool:
+    """
+    拒否された (401 / 429 / Cloudflare チャレンジ) レスポンスかどうか。
+    status_code が無い (ブラウザで開いた) ときは、中身の目印だけで判定する。
+    """
+    if status_code in THROTTLED_STATUS_CODES:
+        return True
+    return UNAUTHORIZED_MARKER in text or is_cloudflare_challenge(text)
+
+
+def _report_to_rate_limiter(url: str, throttled: bool) -> None:
+    """
+    アクセスの結果をレートリミッタに伝えます。 (レートの自動調整用。キャッシュから返したときは呼ばない)
+    """
+    if _rate_limiter is not None:
+        _rate_limiter.report(url, throttled)
+
+
+def map_concurrently(func: Callable[[T], R], items: Iterable[T], concurrency: int) -> Iterator[R]:
+    """
+    items の各要素に func をスレッドで並列に適用して、結果を items の順番どおりに返します。
+    同時に抱える仕事は concurrency の2倍までなので、 items がジェネレータでも全部は読み込まない。
+    """
+    if concurrency <= 1:
+        yield from map(func, items)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    pending: deque[Future[R]] = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= concurrency * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+class ProcessWorkerPool:
+    """
+    workers 個の子プロセスに仕事を渡して、終わった順に結果を受け取るやつ。 (with で使う)
+    各プロセスは最初に worker_context(worker_id, *context_args) に入り、そこで得た関数で仕事を1個ずつ処理する。
+    (Chrome の起動などはプロセスごとに1回だけ。 with を抜けるときに片付く)
+
+    - submit で仕事を渡して、 get で結果を1個受け取る。 len(pool) はまだ結果を受け取っていない仕事の数。
+    - 子プロセスが途中で死んだり (segfault, OOM など)、 worker_context や処理中に例外で終わったりしたら、
+      そのとき抱えていた仕事は error_result(仕事, 理由) を結果として返す。 (黙って消えたり、待ちっぱなしにはしない)
+      子プロセスが全部いなくなったら、残りの仕事も全部 error_result にする。
+    - worker_context, 仕事, 結果は、子プロセスに渡せる (pickle できる) ものにすること。 error_result は親で呼ぶ。
+    - Ctrl+C は親プロセスだけが受け取る。子プロセスは処理中の1個を終えたら、 worker_context を抜けて終わる。
+      stop_timeout_sec 待っても終わらない子プロセスは terminate する。
+    """
+
+    def __init__(
+        self,
+        worker_context: Callable[..., AbstractContextManager[Callable[[T], R]]],
+        context_args: tuple,
+        workers: int,
+        error_result: Callable[[T, str], R],
+        stop_timeout_sec: float = 60,
+    ) -> None:
+        self.error_result = error_result
+        self.stop_timeout_sec = stop_timeout_sec
+        context = multiprocessing.get_context()
+        self._task_queue = context.Queue()
+        self._stop = context.Event()
+        # NOTE: 子プロセスが最後に受け取った仕事の番号。 Queue と違って書いた瞬間に親から見えるので、
+        #       子プロセスが突然死んでも、何を抱えていたかがわかる。
+        self._last_taken = context.Array("q", [-1] * workers, lock=False)
+        self._processes = []
+        # NOTE: 結果は子プロセスごとの Pipe で受け取る。 send は送りきってから返るので (Queue のように裏のスレッドで
+        #       送らないので)、子プロセスが突然死んでも、それより前の結果は失われない。
+        self._connections = {}
+        for worker_id in range(workers):
+            reader, writer = context.Pipe(duplex=False)
+            process = context.Process(
+                target=_run_process_worker,
+                args=(worker_id, worker_context, context_args, self._task_queue, writer, self._stop, self._last_taken),
+                name=f"worker-{worker_id}",
+                daemon=True,
+            )
+            process.start()
+            writer.close()
+            self._processes.append(process)
+            self._connections[worker_id] = reader
+        self._outstanding: dict[int, T] = {}
+        self._lost: deque[tuple[int, str]] = deque()
+        self._next_seq = 0
+        self._closed = False
+
+    def __enter__(self) -> "ProcessWorkerPool":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._outstanding)
+
+    def submit(self, item: T) -> None:
+        seq = self._next_seq
+        self._next_seq += 1
+        self._outstanding[seq] = item
+        self._task_queue.put((seq, item))
+
+    def get(self, timeout: float | None = None) -> R:
+        """
+        終わった仕事の結果を1個返します。 timeout 秒待っても無ければ queue.Empty 。
+        """
+        if not self._outstanding:
+            raise ValueError("結果を待っている仕事がありません")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if not self._connections:
+                self._lose_all("ワーカーが全部終わってしまった")
+            while self._lost:
+                seq, reason = self._lost.popleft()
+                if seq in self._outstanding:
+                    return self.error_result(self._outstanding.pop(seq), reason)
+
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            sentinels = {self._processes[worker_id].sentinel: worker_id for worker_id in self._connections}
+            ready = multiprocessing.connection.wait([*self._connections.values(), *sentinels], timeout=remaining)
+            if not ready:
+                raise queue.Empty
+            # NOTE: 結果を先に読む。 (死んだ子プロセスでも、死ぬ前に送った結果は Pipe に残っている)
+            for connection in ready:
+                if connection in sentinels:
+                    continue
+                worker_id = next(i for i, c in self._connections.items() if c is connection)
+                try:
+                    seq, result = connection.recv()
+                except (EOFError, OSError):
+                    self._mark_exited(worker_id)
+                    continue
+                if self._outstanding.pop(seq, None) is not None:
+                    return result
+            for sentinel in ready:
+                worker_id = sentinels.get(sentinel)
+                if worker_id is not None and worker_id in self._connections:
+                    if self._connections[worker_id].poll():
+                        # NOTE: まだ読んでいない結果がある。次の周で読む。
+                        continue
+                    self._mark_exited(worker_id)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._stop.set()
+        for _ in self._processes:
+            self._task_queue.put(None)
+        for process in self._processes:
+            process.join(timeout=self.stop_timeout_sec)
+            if process.is_alive():
+                logger.warning(f"{process.name} が終わらないので terminate する")
+                process.terminate()
+        for connection in self._connections.values():
+            connection.close()
+        self._connections.clear()
+
+    def _mark_exited(self, worker_id: int) -> None:
+        connection = self._connections.pop(worker_id)
+        connection.close()
+        process = self._processes[worker_id]
+        process.join(timeout=self.stop_timeout_sec)
+        how = "終わった" if process.exitcode == 0 else f"落ちた (exitcode {process.exitcode})"
+        seq = self._last_taken[worker_id]
+        if seq in self._outstanding:
+            logger.error(f"{process.name} が処理中に{how}")
+            self._lost.append((seq, f"{process.name} が処理中に{how}"))
+        elif self._outstanding:
+            logger.warning(f"{process.name} が{how}")
+
+    def _lose_all(self, reason: str) -> None:
+        lost = {seq for seq, _ in self._lost}
+        remaining = [seq for seq in self._outstanding if seq not in lost]
+        if remaining:
+            logger.error(f"{reason}。残りの {len(remaining)} 件はエラー扱いにする")
+        self._lost.extend((seq, reason) for seq in remaining)
+
+
+class InlineWorkerPool:
+    """
+    ProcessWorkerPool と同じ使い方 (submit / get / len) で、このプロセスで順番に処理するやつ。 (ワーカー1個のとき用)
+    """
+
+    def __init__(self, handle: Callable[[T], R]) -> None:
+        self._handle = handle
+        self._items: deque[T] = deque()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def submit(self, item: T) -> None:
+        self._items.append(item)
+
+    def get(self, timeout: float | None = None) -> R:
+        """
+        仕事を1個処理して結果を返します。 (timeout は ProcessWorkerPool と揃えるためだけで、使わない)
+        """
+        return self._handle(self._items.popleft())
+
+
+def _run_process_worker(
+    worker_id: int,
+    worker_context: Callable[..., AbstractContextManager[Callable[[T], R]]],
+    context_args: tuple,
+    task_queue: "multiprocessing.Queue[tuple[int, T] | None]",
+    connection: Any,
+    stop: Any,
+    last_taken: Any,
+) -> None:
+    # NOTE: Ctrl+C は親が受け取って stop で知らせてくる。子は処理中の1個を終えてから、きれいに終わる。
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s [%(levelname)s] [worker-{worker_id}] %(message)s")
+    try:
+        with worker_context(worker_id, *context_args) as handle:
+            while not stop.is_set():
+                task = task_queue.get()
+                if task is None:
+                    break
+                seq, item = task
+                last_taken[worker_id] = seq
+                connection.send((seq, handle(item)))
+    finally:
+        connection.close()
+
+
+# jn が返してくるアクセス拒否ページの目印。
+UNAUTHORIZED_MARKER = "401 Error - Unauthorized Access"
+
+_response_cache: ResponseCache | None = None
+
+
+def configure_response_cache(
+    cache_dir: str | None, ttl_sec: float = 7 * 24 * 60 * 60, max_mb: int = 1024, offline: bool = False
+) -> None:
+    """
+    fetch_html, fetch_html_with_retry, fetch_html_slowly, fetch_network_json_slowly が使う
+    ディスクキャッシュを設定します。
+    cache_dir が None ならキャッシュしない。
+    offline=True なら、キャッシュに無い URL は取りに行かずに CacheMissError にする。
+    """
+    global _response_cache
+    if cache_dir is None:
+        if offline:
+            raise ValueError("--offline には --cache-dir が必要だよ")
+        _response_cache = None
+        return
+    _response_cache = ResponseCache(
+        cache_dir,
+        ttl_sec=ttl_sec,
+        max_bytes=max_mb * 1024 * 1024,
+        offline=offline,
+        # NOTE: 401 ページや Cloudflare チャレンジページを「成功」として覚えちゃうと、次の実行でも失敗し続けるので。
+        reject_markers=(UNAUTHORIZED_MARKER, *CLOUDFLARE_CHALLENGE_MARKERS),
+    )
+    logger.info(f"キャッシュ準備おｋ (dir={cache_dir}, ttl={ttl_sec}秒, max={max_mb}MB, offline={offline})")
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    キャッシュ用のコマンドライン引数を追加します。 configure_response_cache_from_args とセットで使う。
+    """
+    parser.add_argument("--cache-dir", default=None, help="Directory for the on-disk HTTP response cache")
+    parser.add_argument(
+        "--cache-ttl", type=float, default=7 * 24 * 60 * 60, help="Seconds before a cached response expires"
+    )
+    parser.add_argument("--cache-max-mb", type=int, default=1024, help="Max cache size in MB (LRU eviction)")
+    parser.add_argument("--offline", action="store_true", help="Serve only from the cache, never hit the network")
+
+
+def configure_response_cache_from_args(args: argparse.Namespace) -> None:
+    configure_response_cache(args.cache_dir, ttl_sec=args.cache_ttl, max_mb=args.cache_max_mb, offline=args.offline)
+
+
+def _read_cache(url: str) -> str | None:
+    """
+    キャッシュにあれば HTML を返します。オフラインでキャッシュに無ければ CacheMissError 。
+    """
+    if _response_cache is None:
+        return None
+    html = _response_cache.get(url)
+    if html is not None:
+        logger.info(f"キャッシュから取得: {url}")
+        return html
+    if _response_cache.offline:
+        raise CacheMissError(f"オフラインなのにキャッシュに無い: {url}")
+    return None
+
+
+def _write_cache(url: str, html: str) -> None:
+    if _response_cache is not None:
+        _response_cache.put(url, html)
+
+
+# BeautifulSoup のパーサ。 lxml は速いけど、入ってなければ html.parser (pure Python) を使う。
+HTML_PARSER_BACKENDS = ("html.parser", "lxml")
+
+
+def _resolve_html_parser(name: str) -> str:
+    """
+    lxml が入ってなければ html.parser にします。
+    NOTE: make_soup のたびに調べる (と警告が出る) のはうるさいので、設定したときに1回だけ。
+    """
+    if name == "lxml" and importlib.util.find_spec("lxml") is None:
+        logger.warning("lxml が入ってないので html.parser を使う")
+        return "html.parser"
+    return name
+
+
+_html_parser = _resolve_html_parser(os.environ.get("MKMK_HTML_PARSER", "html.parser"))
+
+
+def set_html_parser(name: str) -> None:
+    """
+    jn / jb のパース関数が使う BeautifulSoup のパーサを設定します。
+    環境変数 MKMK_HTML_PARSER でも設定できる。
+    """
+    global _html_parser
+    if name not in HTML_PARSER_BACKENDS:
+        raise ValueError(f"知らないパーサ: {name} ({', '.join(HTML_PARSER_BACKENDS)} のどれかにしてね)")
+    _html_parser = _resolve_html_parser(name)
+    logger.info(f"HTML パーサ: {_html_parser}")
+
+
+def get_html_parser() -> str:
+    return _html_parser
+
+
+def add_html_parser_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--html-parser",
+        choices=HTML_PARSER_BACKENDS,
+        default=None,
+        help="BeautifulSoup parser backend (default: $MKMK_HTML_PARSER or html.parser)",
+    )
+
+
+def configure_html_parser_from_args(args: argparse.Namespace) -> None:
+    if args.html_parser is not None:
+        set_html_parser(args.html_parser)
+
+
+def make_soup(html: str, parse_only: SoupStrainer | None = None, parser: str | None = None) -> BeautifulSoup:
+    """
+    設定されたパーサで BeautifulSoup を作ります。
+    parse_only を渡すと、そこにマッチする部分木だけを作る (ほかの要素はツリーにしないぶん速い)。
+    """
+    return BeautifulSoup(html, parser or get_html_parser(), parse_only=parse_only)
+
+
+CHROME_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"  # noqa: E501
+
+# ブラウザらしいヘッダーを設定
+# NOTE: Accept-Encoding は urllib3 が展開できるもの (gzip, deflate, brotli が入っていれば br も) だけを送る。
+#       展開は requests がやってくれるので、呼び出し側は何も気にしなくていい。
+BROWSER_HEADERS = {
+    "User-Agent": CHROME_USER_AGENT,
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+    "Accept-Encoding": ACCEPT_ENCODING,
+    "Accept-Language": "ja,en-US;q=0.7,en;q=0.3",
+    "Connection": "keep-alive",
+    "Upgrade-Insecure-Requests": "1",
+}
+
+
+# ResourcePolicy.blocked_url_patterns に使う URL パターン。 (CDP Network.setBlockedURLs の形式。 * はワイルドカード)
+FONT_URL_PATTERNS = ("*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot", "*fonts.googleapis.com*", "*fonts.gstatic.com*")
+STYLESHEET_URL_PATTERNS = ("*.css", "*.css?*")
+TRACKER_URL_PATTERNS = (
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+    "*doubleclick.net*",
+    "*googlesyndication.com*",
+    "*adservice.google.*",
+    "*facebook.net*",
+    "*connect.facebook.com*",
+    "*hotjar.com*",
+    "*clarity.ms*",
+    "*static.cloudflareinsights.com*",
+)
+
+
+@dataclass(frozen=True)
+class ResourcePolicy:
+    """
+    headless Chrome に、どのサブリソースを読ませないか。 page_source しか見ないので、画像やフォントはいらない。
+
+    - block_images: Chrome の設定 (prefs) で画像を読まない。
+    - blocked_url_patterns: この URL パターンのリクエストは CDP (Network.setBlockedURLs) で止める。
+    - page_load_strategy: "eager" なら driver.get は DOMContentLoaded で返る (画像などの load を待たない)。
+      NOTE: そのぶん、中身が出るまでは ReadyCondition で待つこと。
+    NOTE: Cloudflare のチェックが通らなくなるサイトもあるので、サイトごとに決める。
+    (jb.RESOURCE_POLICY, jn.RESOURCE_POLICY)
+    """
+
+    block_images: bool = False
+    blocked_url_patterns: tuple[str, ...] = ()
+    page_load_strategy: str = "normal"
+
+    def __post_init__(self) -> None:
+        if self.page_load_strategy not in ("normal", "eager", "none"):
+            raise ValueError(f"page_load_strategy は normal, eager, none のどれか: {self.page_load_strategy}")
+
+
+def add_resource_policy_argument(parser: argparse.ArgumentParser) -> None:
+    """
+    --resource-policy を追加します。 resource_policy_from_args とセットで使う。
+    """
+    parser.add_argument(
+        "--resource-policy",
+        choices=("off", "site"),
+        default="off",
+        help="site: headless Chrome skips images/fonts/trackers and the like per the site's preset "
+        "(jb.RESOURCE_POLICY / jn.RESOURCE_POLICY); off: load everything",
+    )
+
+
+def resource_policy_from_args(args: argparse.Namespace, site_policy: ResourcePolicy) -> ResourcePolicy | None:
+    """
+    --resource-policy が site ならサイトのプリセット、 off なら None (ぜんぶ読む)。
+    """
+    return site_policy if args.resource_policy == "site" else None
+
+
+def _build_chrome_options(
+    capture_network: bool = False, user_data_dir: str | None = None, resource_policy: ResourcePolicy | None = None
+) -> Options:
+    """
+    headless Chrome 用の Options を作ります。
+    Cloudflare の bot 検出を回避するための設定を追加。
+    capture_network=True なら、通信の中身を見られるように performance ログを有効にする。
+    user_data_dir を指定すると、そのディレクトリをプロファイルにする。 (複数プロセスで Chrome を動かすとき用)
+    resource_policy の block_images と page_load_strategy はここで設定する。 (URL のブロックは起動後に CDP で)
+    """
     options = Options()
     # ヘッドレスモード (見えるウィンドウを出さずに裏でウィンドウを動かすこと) を有効化
     options.add_argument("--headless")
@@ -28,44 +725,434 @@ def fetch_html_slowly(url: str, wait_sec: int = 3) -> str:
     options.add_experimental_option("excludeSwitches", ["enable-automation"])
     options.add_experimental_option("useAutomationExtension", False)
     # User-Agent を設定
-    options.add_argument(
-        "--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+    options.add_argument(f"--user-agent={CHROME_USER_AGENT}")
+    if capture_network:
+        options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    if user_data_dir:
+        options.add_argument(f"--user-data-dir={os.path.abspath(user_data_dir)}")
+    if resource_policy is not None:
+        if resource_policy.block_images:
+            options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+        options.page_load_strategy = resource_policy.page_load_strategy
+    return options
+
+
+def _create_chrome_driver(
+    capture_network: bool = False, user_data_dir: str | None = None, resource_policy: ResourcePolicy | None = None
+) -> webdriver.Chrome:
+    """
+    Chrome を1個起動します。
+    """
+    driver = webdriver.Chrome(
+        options=_build_chrome_options(
+            capture_network=capture_network, user_data_dir=user_data_dir, resource_policy=resource_policy
+        )
     )
-    logger.info("options 準備おｋ")
+    try:
+        # WebDriver の自動化検出を無効化
+        driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+        if resource_policy is not None and resource_policy.blocked_url_patterns:
+            driver.execute_cdp_cmd("Network.enable", {})
+            driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": list(resource_policy.blocked_url_patterns)})
+    except Exception:
+        # NOTE: 起動直後にコケたら Chrome プロセスが残らないよう、ここで確実に片付ける。
+        _quit_driver_quietly(driver)
+        raise
+    logger.info("driver 起動おｋ")
+    return driver
+
+
+def _quit_driver_quietly(driver: webdriver.Chrome) -> None:
+    """
+    driver.quit します。すでに死んでる driver の quit で例外が出ても握りつぶします。
+    """
+    try:
+        driver.quit()
+        logger.info("driver.quit おｋ")
+    except Exception as e:
+        logger.warning(f"driver.quit でエラー (無視する): {e}")
+
+
+class ChromeDriverPool:
+    """
+    温まった headless Chrome を最大 size 個まで使い回すプール。
+    with で使うと、抜けるとき (例外で抜けるときも) に全部の Chrome を quit します。
+
+    - driver は必要になったときに起動する (最初から size 個は起動しない)。
+    - max_pages_per_driver ページ処理したら、その driver は捨てて次回は新しく起動する。
+    - 処理中に例外が出た driver は壊れてるかもなので、その場で quit して捨てる。
+    - capture_network=True なら、 fetch_network_json_slowly で通信の中身を取れる driver にする。
+    - user_data_dir を指定すると、そのディレクトリを Chrome のプロファイルにする。
+      NOTE: 1つのプロファイルを同時に2個の Chrome で使うことはできないので、 size=1 のときだけ。
+    - resource_policy を渡すと、画像やフォントなどを読まない Chrome にする。
+    """
+
+    def __init__(
+        self,
+        size: int = 1,
+        max_pages_per_driver: int = 50,
+        capture_network: bool = False,
+        user_data_dir: str | None = None,
+        resource_policy: ResourcePolicy | None = None,
+    ) -> None:
+        if size < 1:
+            raise ValueError(f"size は 1 以上にしてね: {size}")
+        if user_data_dir and size > 1:
+            raise ValueError(f"user_data_dir を使うなら size は 1 にしてね: {size}")
+        self.size = size
+        self.max_pages_per_driver = max_pages_per_driver
+        self.capture_network = capture_network
+        self.user_data_dir = user_data_dir
+        self.resource_policy = resource_policy
+        self._idle: queue.Queue[webdriver.Chrome] = queue.Queue()
+        self._page_counts: dict[int, int] = {}
+        self._all_drivers: set[webdriver.Chrome] = set()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+
+    def __enter__(self) -> "ChromeDriverPool":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    @contextmanager
+    def driver(self) -> Iterator[webdriver.Chrome]:
+        """
+        driver を1個借ります。 with を抜けたらプールに返します。
+        """
+        self._slots.acquire()
+        try:
+            driver = self._checkout()
+            try:
+                yield driver
+            except BaseException:
+                logger.warning("driver 使用中に例外が出たので、この driver は捨てる")
+                self._discard(driver)
+                raise
+            self._checkin(driver)
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        """
+        プールにある Chrome を全部 quit します。
+        """
+        with self._lock:
+            self._closed = True
+            drivers = list(self._all_drivers)
+            self._all_drivers.clear()
+            self._page_counts.clear()
+        for driver in drivers:
+            _quit_driver_quietly(driver)
+        logger.info(f"ChromeDriverPool close おｋ ({len(drivers)} 個 quit)")
 
-    driver = webdriver.Chrome(options=options)
+    def _checkout(self) -> webdriver.Chrome:
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("ChromeDriverPool はもう close されてるよ")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        driver = _create_chrome_driver(
+            capture_network=self.capture_network, user_data_dir=self.user_data_dir, resource_policy=self.resource_policy
+        )
+        with self._lock:
+            self._all_drivers.add(driver)
+            self._page_counts[id(driver)] = 0
+        return driver
+
+    def _checkin(self, driver: webdriver.Chrome) -> None:
+        with self._lock:
+            closed = self._closed
+            pages = self._page_counts.get(id(driver), 0) + 1
+            self._page_counts[id(driver)] = pages
+        if closed:
+            self._discard(driver)
+        elif pages >= self.max_pages_per_driver:
+            logger.info(f"driver が {pages} ページ処理したので入れ替える")
+            self._discard(driver)
+        else:
+            self._idle.put(driver)
+
+    def _discard(self, driver: webdriver.Chrome) -> None:
+        with self._lock:
+            self._all_drivers.discard(driver)
+            self._page_counts.pop(id(driver), None)
+        _quit_driver_quietly(driver)
+
+
+@dataclass(frozen=True)
+class ReadyCondition:
+    """
+    「ページの準備できた」の判定条件。
+    どれか1つでも満たしたら、 fetch_html_slowly はその時点で HTML を返します。
+
+    - selector: この CSS セレクタの要素が出てきたら準備おｋ。
+    - script: この JS (return で真偽値を返す) が truthy になったら準備おｋ。
+    - no_result_selector / no_result_texts: 「0件でした」の目印。出てきたらもう待っても無駄なので返す。
+    """
+
+    selector: str | None = None
+    script: str | None = None
+    no_result_selector: str | None = None
+    no_result_texts: tuple[str, ...] = ()
+
+
+# NOTE: page_source (DOM 全体のシリアライズ) は重いので、タイトルと本文テキストだけを JS で見る。
+_PAGE_CONTAINS_ANY_SCRIPT = (
+    "const text = document.title + '\\n' + (document.body ? document.body.innerText : '');"
+    "return arguments[0].some((marker) => text.includes(marker));"
+)
+
+# Cloudflare チャレンジページの目印。
+CLOUDFLARE_CHALLENGE_MARKERS = ("Just a moment...", "Verify you are human")
+
+
+def is_cloudflare_challenge(html: str) -> bool:
+    """
+    HTML が Cloudflare チャレンジページっぽいかどうか。
+    """
+    return any(marker in html for marker in CLOUDFLARE_CHALLENGE_MARKERS)
+
+
+def _page_contains_any(driver: webdriver.Chrome, markers: tuple[str, ...]) -> bool:
+    return bool(driver.execute_script(_PAGE_CONTAINS_ANY_SCRIPT, list(markers)))
 
-    # WebDriver の自動化検出を無効化
-    driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
 
+def _is_ready(driver: webdriver.Chrome, ready: ReadyCondition) -> bool:
+    if ready.selector and driver.find_elements(By.CSS_SELECTOR, ready.selector):
+        return True
+    if ready.script and driver.execute_script(ready.script):
+        return True
+    if ready.no_result_selector and driver.find_elements(By.CSS_SELECTOR, ready.no_result_selector):
+        logger.info("0件の目印を検出")
+        return True
+    if ready.no_result_texts and _page_contains_any(driver, ready.no_result_texts):
+        logger.info("0件の目印を検出")
+        return True
+    return False
+
+
+def _wait_until_ready(driver: webdriver.Chrome, ready: ReadyCondition, timeout_sec: float) -> bool:
+    """
+    ready を満たすまで待ちます。 timeout_sec 待ってもダメなら、あきらめてそのまま進みます。
+    満たしたかどうかを返す。
+    """
+    started = time.monotonic()
+    try:
+        WebDriverWait(driver, timeout_sec, poll_frequency=0.2).until(lambda d: _is_ready(d, ready))
+        logger.info(f"ready おｋ ({time.monotonic() - started:.2f}秒)")
+        return True
+    except TimeoutException:
+        logger.warning(f"ready 条件を {timeout_sec} 秒待ったけどダメだった。このまま進む")
+        return False
+
+
+def _load_page(
+    driver: webdriver.Chrome, url: str, wait_sec: int, ready: ReadyCondition | None = None
+) -> tuple[str, bool]:
+    """
+    起動済みの driver で URL を開き、のんびり待ってから (HTML, ready を満たしたか) を返します。
+    ready を渡さなければ (wait_sec 寝るだけなので) いつも True 。
+    """
+    _wait_for_rate_limit(url)
     driver.get(url)
     logger.info("driver.get おｋ")
 
     # Cloudflare チャレンジページかどうかをチェック。
-    if "Just a moment..." in driver.page_source or "Verify you are human" in driver.page_source:
+    # NOTE: 待っているうちに突破できても、チャレンジが出たこと自体は「速すぎ」としてレートリミッタに伝える。
+    challenged = _page_contains_any(driver, CLOUDFLARE_CHALLENGE_MARKERS)
+    if challenged:
         logger.info("Cloudflare チャレンジページを検出、待機中...")
         # より長い時間待機してチャレンジの完了を待つ
         max_wait = 30  # 最大30秒待機
-        for i in range(max_wait):
-            time.sleep(1)
-            if "Just a moment..." not in driver.page_source and "Verify you are human" not in driver.page_source:
-                logger.info(f"Cloudflare チャレンジ完了 ({i + 1}秒後)")
-                break
-            if i == max_wait - 1:
-                logger.warning("Cloudflare チャレンジのタイムアウト")
-
-    # 通常の待機時間
-    time.sleep(wait_sec)
-    logger.info("sleep おｋ")
+        started = time.monotonic()
+        try:
+            WebDriverWait(driver, max_wait, poll_frequency=0.5).until_not(
+                lambda d: _page_contains_any(d, CLOUDFLARE_CHALLENGE_MARKERS)
+            )
+            logger.info(f"Cloudflare チャレンジ完了 ({time.monotonic() - started:.1f}秒後)")
+        except TimeoutException:
+            logger.warning("Cloudflare チャレンジのタイムアウト")
+
+    if ready is None:
+        # 通常の待機時間
+        time.sleep(wait_sec)
+        logger.info("sleep おｋ")
+        is_ready = True
+    else:
+        # 準備できたらすぐ次へ。 wait_sec はタイムアウトとしてだけ使う。
+        is_ready = _wait_until_ready(driver, ready, wait_sec)
 
     html = driver.page_source
     logger.info("page_source おｋ")
+    _report_to_rate_limiter(url, challenged or is_throttled_response(html))
+    return html, is_ready
+
+
+def _write_cache_if_ready(url: str, html: str, is_ready: bool) -> None:
+    """
+    ready を満たしたページだけキャッシュに書きます。
+    NOTE: タイムアウトした描画途中のページをキャッシュすると、次から (期限が切れるまで) ずっとそれを返してしまう。
+    (空の一覧ページだと、クロールがそこで終わってしまう)
+    """
+    if is_ready:
+        _write_cache(url, html)
+    else:
+        logger.warning(f"ready にならなかったのでキャッシュしない: {url}")
+
+
+def fetch_html_slowly(
+    url: str,
+    wait_sec: int = 3,
+    pool: ChromeDriverPool | None = None,
+    ready: ReadyCondition | None = None,
+) -> str:
+    """
+    指定された URL にアクセスし、JavaScript 実行後の HTML をのんびり取得します。
+    pool を渡すと、温まった Chrome を使い回します。
+    渡さなければ、今回かぎりの Chrome を起動して、終わったら (例外でも) 必ず quit します。
+    ready を渡すと、 wait_sec 秒まるまる寝るのではなく、条件を満たした時点で返します (wait_sec はタイムアウト)。
+    """
+    cached = _read_cache(url)
+    if cached is not None:
+        return cached
+
+    if pool is None:
+        with ChromeDriverPool(size=1) as one_shot_pool, one_shot_pool.driver() as driver:
+            html, is_ready = _load_page(driver, url, wait_sec, ready=ready)
+    else:
+        with pool.driver() as driver:
+            html, is_ready = _load_page(driver, url, wait_sec, ready=ready)
 
-    driver.quit()
-    logger.info("driver.quit おｋ")
+    _write_cache_if_ready(url, html, is_ready)
     return html
 
 
+def fetch_network_json_slowly(
+    url: str,
+    wait_sec: int = 3,
+    pool: ChromeDriverPool | None = None,
+    ready: ReadyCondition | None = None,
+    url_filter: str | None = None,
+) -> list[dict[str, Any]]:
+    """
+    fetch_html_slowly の通信キャプチャ版。
+    ページを開いて、その間にページが XHR / fetch で受け取った JSON を [{url, json}, ...] で返します。
+    url_filter を渡すと、その文字列を URL に含むレスポンスだけ返す。
+    pool は capture_network=True で作ったものを渡すこと。渡さなければ今回かぎりの Chrome を起動する。
+    キャプチャした JSON は (HTML とは別のキーで) キャッシュするので、 --offline でも Chrome を起動しない。
+    """
+    cache_key = f"{url}#captured-json={url_filter or ''}"
+    cached = _read_cache(cache_key)
+    if cached is not None:
+        return json.loads(cached)
+
+    if pool is None:
+        with ChromeDriverPool(size=1, capture_network=True) as one_shot_pool:
+            return fetch_network_json_slowly(url, wait_sec, pool=one_shot_pool, ready=ready, url_filter=url_filter)
+    if not pool.capture_network:
+        raise ValueError("capture_network=True の ChromeDriverPool を渡してね")
+
+    with pool.driver() as driver:
+        # NOTE: 使い回しの driver には前のページのログが残ってるので、先に読み捨てる。
+        driver.get_log("performance")
+        _, is_ready = _load_page(driver, url, wait_sec, ready=ready)
+        payloads = _collect_json_responses(driver, url_filter)
+    logger.info(f"JSON レスポンスのキャプチャおｋ: {len(payloads)} 件")
+    _write_cache_if_ready(cache_key, json.dumps(payloads, ensure_ascii=False), is_ready)
+    return payloads
+
+
+def _collect_json_responses(driver: webdriver.Chrome, url_filter: str | None) -> list[dict[str, Any]]:
+    """
+    performance ログ (CDP の Network イベント) から、 XHR / fetch の JSON レスポンスの中身を集めます。
+    """
+    payloads = []
+    for entry in driver.get_log("performance"):
+        message = json.loads(entry["message"])["message"]
+        if message.get("method") != "Network.responseReceived":
+            continue
+        params = message["params"]
+        response = params["response"]
+        if params.get("type") not in ("XHR", "Fetch") or "json" not in response.get("mimeType", ""):
+            continue
+        if url_filter and url_filter not in response["url"]:
+            continue
+        try:
+            body = driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": params["requestId"]})
+        except WebDriverException as e:
+            # NOTE: もうブラウザが捨てたレスポンスとか。
+            logger.warning(f"レスポンスの中身が取れなかった: {response['url']} ({e.msg})")
+            continue
+        text = base64.b64decode(body["body"]).decode("utf-8") if body.get("base64Encoded") else body["body"]
+        try:
+            payloads.append({"url": response["url"], "json": json.loads(text)})
+        except json.JSONDecodeError:
+            logger.warning(f"JSON じゃなかった: {response['url']}")
+    return payloads
+
+
+class CloudflareClearance:
+    """
+    Cloudflare のチャレンジはブラウザで1回だけ突破して、
+    そのとき手に入れた cookie (cf_clearance など) と User-Agent を requests.Session に引き継ぐ。
+    以降のページは素の HTTP で取りに行き、またチャレンジが出たときだけブラウザに戻ります。
+
+    NOTE: JavaScript で描画しないと中身が出ないページには使えない (HTTP だと空っぽの HTML になる)。
+    """
+
+    def __init__(self, pool: ChromeDriverPool, session: requests.Session | None = None) -> None:
+        self.pool = pool
+        self.session = session or create_http_session()
+        self._has_clearance = False
+
+    def fetch(self, url: str, wait_sec: int = 3, ready: ReadyCondition | None = None) -> str:
+        """
+        clearance を持っていれば HTTP で、持っていなければブラウザで HTML を取得します。
+        """
+        if self._has_clearance:
+            try:
+                html = fetch_html_with_retry(url, max_retries=1, session=self.session)
+            except requests.exceptions.RequestException as e:
+                logger.info(f"HTTP で取れなかったのでブラウザに戻る: {e}")
+            else:
+                if not is_cloudflare_challenge(html):
+                    logger.info("HTTP (clearance 引き継ぎ) で取得おｋ")
+                    return html
+                logger.info("チャレンジが再来したのでブラウザに戻る")
+            self._has_clearance = False
+        else:
+            cached = _read_cache(url)
+            if cached is not None:
+                return cached
+
+        with self.pool.driver() as driver:
+            html, is_ready = _load_page(driver, url, wait_sec, ready=ready)
+            if not is_cloudflare_challenge(html):
+                self._import_clearance(driver)
+        _write_cache_if_ready(url, html, is_ready)
+        return html
+
+    def _import_clearance(self, driver: webdriver.Chrome) -> None:
+        """
+        ブラウザの cookie と User-Agent を session にコピーします。
+        NOTE: cf_clearance は User-Agent とセットで有効なので、 User-Agent も必ずそろえる。
+        """
+        cookies = driver.get_cookies()
+        for cookie in cookies:
+            self.session.cookies.set(
+                cookie["name"], cookie["value"], domain=cookie.get("domain"), path=cookie.get("path", "/")
+            )
+        self.session.headers["User-Agent"] = driver.execute_script("return navigator.userAgent")
+        self._has_clearance = True
+        has_cf_clearance = any(cookie["name"] == "cf_clearance" for cookie in cookies)
+        logger.info(f"clearance を session に引き継ぎおｋ (cf_clearance: {has_cf_clearance}, cookie {len(cookies)} 個)")
+
+
 def save_to_xlsx(data: list[dict[str, str]], filename: str) -> None:
     """
     辞書のリストを xlsx ファイルとして保存します。
@@ -100,48 +1187,210 @@ def normalize_csv_data(text: str) -> str:
     return text.strip()
 
 
-def fetch_html(url: str) -> str:
+def map_unique_values(values: pd.Series, func: Callable[[str], str]) -> pd.Series:
+    """
+    Series の各値に func をかけた Series を返します。 (Series.apply(func) と同じ結果。ただし NaN は NaN のまま)
+    重複を除いた値にだけ func をかけて、元の並びに戻す。住所や検索ワードは同じ値が何回も出てくるので、そのぶん速い。
+    """
+    codes, uniques = pd.factorize(values)
+    # NOTE: 最後に NaN を足しておくと、 factorize が NaN につける -1 でそのまま NaN が引ける。
+    mapped = np.array([func(value) for value in uniques] + [np.nan], dtype=object)
+    return pd.Series(mapped[codes], index=values.index, name=values.name)
+
+
+def create_http_session(pool_size: int = 10) -> requests.Session:
+    """
+    keep-alive で TCP/TLS 接続を使い回す requests.Session を作ります。
+    pool_size はホストごとに持っておく接続の数 (同時に投げるリクエスト数より大きくしておく)。
+    """
+    session = requests.Session()
+    # NOTE: リトライは fetch_html_with_retry でやるので、 adapter では何もしない。
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(BROWSER_HEADERS)
+    return session
+
+
+_http_session: requests.Session | None = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """
+    モジュール共通の requests.Session を返します。最初に呼ばれたときに作ります。
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            _http_session = create_http_session()
+        return _http_session
+
+
+def configure_http_session(pool_size: int) -> None:
+    """
+    モジュール共通の requests.Session を、指定の接続プールサイズで作り直します。
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is not None:
+            _http_session.close()
+        _http_session = create_http_session(pool_size=pool_size)
+    logger.info(f"HTTP session 準備おｋ (pool_size={pool_size})")
+
+
+def fetch_html(url: str, pretty: bool = False) -> str:
+    """
+    指定された URL の HTML を取得する
+    pretty=True なら、構造を見やすく整形して返す (デバッグ用。遅いので普段は使わない)
+    """
+
+    html = _read_cache(url)
+    if html is None:
+        _wait_for_rate_limit(url)
+        response = get_http_session().get(url, timeout=10)
+        if response.encoding is None or response.encoding == "ISO-8859-1":
+            response.encoding = "utf-8"
+        html = response.text
+        _report_to_rate_limiter(url, is_throttled_response(html, response.status_code))
+        response.raise_for_status()
+
+        _write_cache(url, html)
+
+    if pretty:
+        return BeautifulSoup(html, "html.parser").prettify()
+    return html
+
+
+def _is_retryable(error: requests.exceptions.RequestException) -> bool:
     """
-    指定された URL の HTML を取得して構造を表示する
+    リトライしたら良くなりそうなエラーかどうか。
+    接続エラーやタイムアウト、 429 や 5xx はリトライする。 404 みたいな 4xx は何回やっても同じなのでしない。
     """
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
 
-    response = requests.get(url)
-    response.raise_for_status()
 
-    soup = BeautifulSoup(response.text, "html.parser")
-    return soup.prettify()
+def _backoff_delay(
+    attempt: int, wait_sec: float, max_wait_sec: float, error: requests.exceptions.RequestException
+) -> float:
+    """
+    指数バックオフ + ジッターの待ち時間。
+    wait_sec, wait_sec * 2, wait_sec * 4, ... (上限 max_wait_sec) の、後ろ半分の範囲でランダムに待つ。
+    429 で Retry-After (秒) がついてたら、それより短くはしない。
+    """
+    delay = min(max_wait_sec, wait_sec * (2**attempt))
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+    if retry_after.isdigit():
+        delay = max(delay, min(max_wait_sec, float(retry_after)))
+    return delay
 
 
-def fetch_html_with_retry(url: str, max_retries: int = 3, wait_sec: int = 2) -> str:
+def fetch_html_with_retry(
+    url: str,
+    max_retries: int = 3,
+    wait_sec: float = 2,
+    session: requests.Session | None = None,
+    max_wait_sec: float = 30,
+) -> str:
     """
     リトライ機能付きで HTML を取得し、文字列を返す
+    リトライの間隔は wait_sec から始まる指数バックオフ (ジッターつき)。
+    session を渡すと、その session (cookie とヘッダー) で取得します。渡さなければモジュール共通の session を使います。
+    """
+    cached = _read_cache(url)
+    if cached is not None:
+        return cached
+
+    html = fetch_response_with_retry(url, max_retries, wait_sec, session, max_wait_sec).text
+    _write_cache(url, html)
+    return html
+
+
+class ConditionalFetchResult(NamedTuple):
+    """
+    fetch_html_if_modified の結果。 html が None なら 304 (前回から変わってない)。
+    etag, last_modified は、次回の fetch_html_if_modified に渡す値。 (無ければ空文字列)
+    """
+
+    html: str | None
+    etag: str
+    last_modified: str
+
+
+def fetch_html_if_modified(
+    url: str, etag: str = "", last_modified: str = "", session: requests.Session | None = None
+) -> ConditionalFetchResult:
+    """
+    条件つき GET (If-None-Match / If-Modified-Since) で HTML を取得します。
+    前回の etag, last_modified を渡すと、変わっていなければ本文なしの 304 で済む。
+    NOTE: validator があるときは再検証が目的なので、キャッシュは読まない (取れた HTML はキャッシュに書く)。
+    ただしオフラインならキャッシュだけ見る (validator はそのまま返す。キャッシュに無ければ CacheMissError) 。
+    validator が無ければふつうの GET なので、キャッシュにあればそれを使う (このとき validator は空) 。
     """
-    # ブラウザらしいヘッダーを設定 (Accept-Encoding を削除して圧縮を無効化)
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",  # noqa: E501
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-        "Accept-Language": "ja,en-US;q=0.7,en;q=0.3",
-        "Connection": "keep-alive",
-        "Upgrade-Insecure-Requests": "1",
-    }
+    if not (etag or last_modified) or (_response_cache is not None and _response_cache.offline):
+        cached = _read_cache(url)
+        if cached is not None:
+            return ConditionalFetchResult(cached, etag, last_modified)
+
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    response = fetch_response_with_retry(url, session=session, headers=headers)
+    if response.status_code == 304:
+        # NOTE: 304 には validator がついてこないこともあるので、そのときは前回のを使い続ける。
+        return ConditionalFetchResult(
+            None, response.headers.get("ETag", etag), response.headers.get("Last-Modified", last_modified)
+        )
+    _write_cache(url, response.text)
+    return ConditionalFetchResult(
+        response.text, response.headers.get("ETag", ""), response.headers.get("Last-Modified", "")
+    )
+
+
+def fetch_response_with_retry(
+    url: str,
+    max_retries: int = 3,
+    wait_sec: float = 2,
+    session: requests.Session | None = None,
+    max_wait_sec: float = 30,
+    headers: dict[str, str] | None = None,
+) -> requests.Response:
+    """
+    fetch_html_with_retry の中身。キャッシュは見ずに取りに行って、レスポンス (ヘッダーつき) をそのまま返す。
+    headers はこのリクエストだけに足すヘッダー。 304 はエラーにしない。
+    """
+    session = session or get_http_session()
 
     for attempt in range(max_retries):
         try:
-            response = requests.get(url, headers=headers, timeout=10)
-            response.raise_for_status()
+            _wait_for_rate_limit(url)
+            response = session.get(url, timeout=10, headers=headers)
 
             # エンコーディングを明示的に設定
             if response.encoding is None or response.encoding == "ISO-8859-1":
                 response.encoding = "utf-8"
 
-            return response.text
+            _report_to_rate_limiter(url, is_throttled_response(response.text, response.status_code))
+            response.raise_for_status()
+            return response
 
-        except requests.exceptions.RequestException:
-            if attempt < max_retries - 1:
-                time.sleep(wait_sec)
+        except requests.exceptions.RequestException as e:
+            if attempt < max_retries - 1 and _is_retryable(e):
+                delay = _backoff_delay(attempt, wait_sec, max_wait_sec, e)
+                logger.warning(f"取得失敗、 {delay:.1f} 秒後にリトライ ({attempt + 1}/{max_retries}): {e}")
+                time.sleep(delay)
             else:
                 raise
 
+    raise RuntimeError("max_retries は 1 以上にしてね")
+
 
 def show_progress_with_name(current: int, total: int, name: str) -> None:
     """
@@ -0,0 +1,232 @@
+import argparse
+import json
+import logging
+import random
+import sqlite3
+import time
+from collections.abc import Iterable, Iterator
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+# タスクの状態。
+PENDING = "pending"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL DEFAULT '',
+    state TEXT NOT NULL DEFAULT 'pending',
+    priority INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_eligible_at REAL NOT NULL DEFAULT 0,
+    last_error TEXT NOT NULL DEFAULT '',
+    result TEXT,
+    updated_at REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tasks_queue ON tasks (state, priority DESC, next_eligible_at);
+"""
+
+
+class Task(NamedTuple):
+    """
+    TaskStore.claim で取り出したタスク1件。
+    """
+
+    key: str
+    url: str
+    priority: int
+    attempts: int
+
+
+class TaskStore:
+    """
+    タスク (例: 1つの検索 URL の検索) ごとの状態を SQLite に持っておくやつ。
+    状態は pending (未処理 / やり直し待ち) -> in_flight (処理中) -> done (完了) か failed (もうあきらめた)。
+
+    - claim で、いま処理していい pending のタスクを priority の高い順に取り出して、 in_flight にする。
+    - fail すると attempts を数えて、 max_attempts 回未満なら、指数バックオフ (ジッターつき) で
+      next_eligible_at をずらして pending に戻す。 priority は1下げる (新しいタスクを先にやる)。
+      max_attempts 回失敗したら failed 。
+    - complete / fail に result ({列: 値}) を渡すと覚えておいて、あとで finished_results で引ける。
+    - 開いたとき in_flight のタスクは、前回の実行が途中で落ちたものなので pending に戻す。
+    - set_scope で、 claim / next_eligible_at / counts / finished_results が見るタスクを今回の key だけにできる。
+      (1個の db を別の CSV の実行と共有しても、ほかの実行のタスクを取ったり待ったりしない)
+    - NOTE: 1個の接続を1スレッドで使う前提。 (ワーカーの子プロセスには渡さず、親で使う)
+    """
+
+    def __init__(
+        self, path: str, max_attempts: int = 5, backoff_sec: float = 60, max_backoff_sec: float = 60 * 60
+    ) -> None:
+        if max_attempts < 1:
+            raise ValueError(f"max_attempts は 1 以上にしてね: {max_attempts}")
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff_sec = backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+        self._conn = sqlite3.connect(path)
+        self._scoped = False
+        # NOTE: 1件ごとに commit するので、 WAL + synchronous=NORMAL で fsync を減らす。
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+            recovered = self._conn.execute(
+                "UPDATE tasks SET state = ?, updated_at = ? WHERE state = ?", (PENDING, time.time(), IN_FLIGHT)
+            ).rowcount
+        if recovered:
+            logger.info(f"前回処理中のまま終わったタスク {recovered} 件を pending に戻した: {path}")
+
+    def __enter__(self) -> "TaskStore":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def set_scope(self, keys: Iterable[str]) -> None:
+        """
+        このあと claim / next_eligible_at / counts / finished_results で見るタスクを、 keys のものだけにします。
+        """
+        with self._conn:
+            self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS scope (key TEXT PRIMARY KEY)")
+            self._conn.execute("DELETE FROM temp.scope")
+            self._conn.executemany("INSERT OR IGNORE INTO temp.scope (key) VALUES (?)", ((key,) for key in keys))
+        self._scoped = True
+
+    def _in_scope(self, keyword: str = "AND") -> str:
+        """
+        set_scope したときだけ付ける WHERE の条件。
+        """
+        return f" {keyword} key IN (SELECT key FROM temp.scope)" if self._scoped else ""
+
+    def add_many(self, tasks: Iterable[tuple[str, str]], priority: int = 0) -> int:
+        """
+        (key, url) のタスクをまとめて pending で追加して、追加できた件数を返します。
+        すでにある key は何もしない (状態も attempts もそのまま)。
+        """
+        now = time.time()
+        with self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO tasks (key, url, priority, updated_at) VALUES (?, ?, ?, ?)",
+                ((key, url, priority, now) for key, url in tasks),
+            )
+            return self._conn.total_changes - before
+
+    def claim(self, limit: int | None = None) -> list[Task]:
+        """
+        いま処理していい pending のタスクを、 priority の高い順 (同じなら next_eligible_at の早い順) に
+        最大 limit 件 (None なら全部) 取り出して、 in_flight にします。
+        """
+        now = time.time()
+        with self._conn:
+            rows = self._conn.execute(
+                "SELECT key, url, priority, attempts FROM tasks WHERE state = ? AND next_eligible_at <= ?"
+                + self._in_scope()
+                + " ORDER BY priority DESC, next_eligible_at, rowid LIMIT ?",
+                (PENDING, now, -1 if limit is None else limit),
+            ).fetchall()
+            self._conn.executemany(
+                "UPDATE tasks SET state = ?, updated_at = ? WHERE key = ?", ((IN_FLIGHT, now, row[0]) for row in rows)
+            )
+        return [Task(*row) for row in rows]
+
+    def complete(self, key: str, result: dict[str, str] | None = None) -> None:
+        with self._conn:
+            self._conn.execute(
+                "UPDATE tasks SET state = ?, result = ?, updated_at = ? WHERE key = ?",
+                (DONE, _dump_result(result), time.time(), key),
+            )
+
+    def fail(self, key: str, error: str, result: dict[str, str] | None = None) -> str:
+        """
+        タスクの失敗を記録して、新しい状態 (pending か failed) を返します。
+        """
+        with self._conn:
+            row = self._conn.execute("SELECT attempts FROM tasks WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            attempts = row[0] + 1
+            now = time.time()
+            if attempts >= self.max_attempts:
+                self._conn.execute(
+                    "UPDATE tasks SET state = ?, attempts = ?, last_error = ?, result = ?, updated_at = ? "
+                    "WHERE key = ?",
+                    (FAILED, attempts, error, _dump_result(result), now, key),
+                )
+                logger.warning(f"[{key}] {attempts} 回失敗したのであきらめる: {error}")
+                return FAILED
+            delay = self._backoff_delay(attempts)
+            self._conn.execute(
+                "UPDATE tasks SET state = ?, attempts = ?, priority = priority - 1, next_eligible_at = ?, "
+                "last_error = ?, result = ?, updated_at = ? WHERE key = ?",
+                (PENDING, attempts, now + delay, error, _dump_result(result), now, key),
+            )
+        logger.info(f"[{key}] 失敗 ({attempts}/{self.max_attempts})、 {delay:.0f} 秒後にやり直す: {error}")
+        return PENDING
+
+    def finished_results(self) -> Iterator[tuple[str, dict[str, str]]]:
+        """
+        done か failed のタスクの (key, 覚えている result) 。 result を渡さなかったタスクは出てこない。
+        """
+        rows = self._conn.execute(
+            "SELECT key, result FROM tasks WHERE state IN (?, ?) AND result IS NOT NULL" + self._in_scope(),
+            (DONE, FAILED),
+        ).fetchall()
+        for key, result in rows:
+            yield key, json.loads(result)
+
+    def next_eligible_at(self) -> float | None:
+        """
+        pending のタスクがいちばん早く処理していいようになる時刻 (time.time)。 pending が無ければ None 。
+        """
+        row = self._conn.execute(
+            "SELECT MIN(next_eligible_at) FROM tasks WHERE state = ?" + self._in_scope(), (PENDING,)
+        ).fetchone()
+        return row[0]
+
+    def counts(self) -> dict[str, int]:
+        """
+        状態ごとのタスクの数。
+        """
+        counts = dict.fromkeys((PENDING, IN_FLIGHT, DONE, FAILED), 0)
+        counts.update(
+            self._conn.execute(
+                "SELECT state, COUNT(*) FROM tasks" + self._in_scope("WHERE") + " GROUP BY state"
+            ).fetchall()
+        )
+        return counts
+
+    def _backoff_delay(self, attempts: int) -> float:
+        """
+        backoff_sec, backoff_sec * 2, backoff_sec * 4, ... (上限 max_backoff_sec) の、後ろ半分の範囲でランダムに待つ。
+        """
+        delay = min(self.max_backoff_sec, self.backoff_sec * (2 ** (attempts - 1)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _dump_result(result: dict[str, str] | None) -> str | None:
+    return None if result is None else json.dumps(result, ensure_ascii=False)
+
+
+def add_task_store_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    TaskStore 用のコマンドライン引数を追加します。 open_task_store_from_args とセットで使う。
+    """
+    parser.add_argument(
+        "--task-db",
+        default=None,
+        help="SQLite file tracking each row's state; rows that hit 401 or errors are retried with backoff",
+    )
+    parser.add_argument("--max-attempts", type=int, default=5, help="Give up on a row after this many failures")
+    parser.add_argument("--retry-backoff-sec", type=float, default=60, help="Wait before the first retry (doubles)")
+
+
+def open_task_store_from_args(args: argparse.Namespace) -> TaskStore:
+    return TaskStore(args.task_db, max_attempts=args.max_attempts, backoff_sec=args.retry_backoff_sec)